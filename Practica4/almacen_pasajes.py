@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import hashlib
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+
+NOMBRE_CORPUS_QUIJOTE = "quijote"
+
+
+class Pasaje:
+    __slots__ = ("almacen", "indice", "score")
+
+    def __init__(
+        self, almacen: AlmacenPasajes, indice: int, score: float = 0.0
+    ) -> None:
+        self.almacen = almacen
+        self.indice = indice
+        self.score = score
+
+    @property
+    def texto(self) -> str:
+        return self.almacen.obtener_texto(self.indice)
+
+    @property
+    def encabezado(self) -> str:
+        return self.almacen.obtener_encabezado(self.indice)
+
+    @property
+    def titulo(self) -> str:
+        return self.almacen.titulo
+
+
+class Chunk(Pasaje):
+    __slots__ = ()
+
+    @property
+    def inicio(self) -> int:
+        return int(self.almacen.inicios[self.indice])
+
+    @property
+    def fin(self) -> int:
+        return int(self.almacen.fines[self.indice])
+
+
+class AlmacenPasajes:
+    def __init__(
+        self,
+        buffer: bytes | bytearray | np.ndarray,
+        offsets: np.ndarray,
+        encabezados: tuple[str, ...],
+        ids_encabezado: np.ndarray,
+        titulo: str = "",
+        nombre: str = NOMBRE_CORPUS_QUIJOTE,
+    ) -> None:
+        self.buffer = memoryview(buffer).cast("B")
+        self.offsets = offsets
+        self.encabezados = encabezados
+        self.ids_encabezado = ids_encabezado
+        self.titulo = titulo
+        self.nombre = nombre
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, indice: int) -> Pasaje:
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        return Pasaje(self, indice)
+
+    def __iter__(self) -> Iterator[Pasaje]:
+        return (self[indice] for indice in range(len(self)))
+
+    def obtener_texto(self, indice: int) -> str:
+        inicio, fin = self.offsets[indice : indice + 2]
+        return str(self.buffer[inicio:fin], "utf-8")
+
+    def obtener_encabezado(self, indice: int) -> str:
+        return self.encabezados[self.ids_encabezado[indice]]
+
+    def iterar_textos(self) -> Iterator[str]:
+        limites = self.offsets.tolist()
+        for inicio, fin in zip(limites[:-1], limites[1:]):
+            yield str(self.buffer[inicio:fin], "utf-8")
+
+    def calcular_hashes(self) -> np.ndarray:
+        limites = self.offsets.tolist()
+        return np.fromiter(
+            (
+                int.from_bytes(
+                    hashlib.blake2b(self.buffer[inicio:fin], digest_size=8).digest(),
+                    "little",
+                )
+                for inicio, fin in zip(limites[:-1], limites[1:])
+            ),
+            dtype=np.uint64,
+            count=len(self),
+        )
+
+    def calcular_hash(self) -> str:
+        resumen = hashlib.blake2b(digest_size=16)
+        resumen.update(self.buffer)
+        resumen.update(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+        resumen.update("\0".join(self.encabezados).encode("utf-8"))
+        resumen.update(
+            np.ascontiguousarray(self.ids_encabezado, dtype=np.int32).tobytes()
+        )
+        return resumen.hexdigest()
+
+    def calcular_memoria(self) -> int:
+        return (
+            self.buffer.nbytes
+            + self.offsets.nbytes
+            + self.ids_encabezado.nbytes
+            + sum(len(encabezado.encode("utf-8")) for encabezado in self.encabezados)
+        )
+
+
+class AlmacenChunks(AlmacenPasajes):
+    def __init__(
+        self,
+        buffer: bytes | bytearray | np.ndarray,
+        offsets: np.ndarray,
+        encabezados: tuple[str, ...],
+        ids_encabezado: np.ndarray,
+        inicios: np.ndarray,
+        fines: np.ndarray,
+        titulo: str = "",
+        nombre: str = NOMBRE_CORPUS_QUIJOTE,
+    ) -> None:
+        super().__init__(buffer, offsets, encabezados, ids_encabezado, titulo, nombre)
+        self.inicios = inicios
+        self.fines = fines
+
+    def __getitem__(self, indice: int) -> Chunk:
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        return Chunk(self, indice)
+
+    def calcular_memoria(self) -> int:
+        return super().calcular_memoria() + self.inicios.nbytes + self.fines.nbytes
+
+
+def codificar_textos(
+    textos: list[str] | tuple[str, ...],
+) -> tuple[np.ndarray, np.ndarray]:
+    codificados = [texto.encode("utf-8") for texto in textos]
+    offsets = np.zeros(len(codificados) + 1, dtype=np.int64)
+    np.cumsum([len(texto) for texto in codificados], out=offsets[1:])
+    return np.frombuffer(b"".join(codificados), dtype=np.uint8), offsets
+
+
+def decodificar_textos(buffer: np.ndarray, offsets: np.ndarray) -> list[str]:
+    datos = buffer.tobytes()
+    limites = offsets.tolist()
+    return [
+        datos[inicio:fin].decode("utf-8")
+        for inicio, fin in zip(limites[:-1], limites[1:])
+    ]
+
+
+def empaquetar_textos(
+    entradas: Iterable[tuple[str, str]],
+) -> tuple[bytearray, np.ndarray, tuple[str, ...], np.ndarray]:
+    buffer = bytearray()
+    offsets = [0]
+    ids_encabezados: dict[str, int] = {}
+    ids_encabezado: list[int] = []
+
+    for encabezado, texto in entradas:
+        buffer += texto.encode("utf-8")
+        offsets.append(len(buffer))
+        ids_encabezado.append(
+            ids_encabezados.setdefault(encabezado, len(ids_encabezados))
+        )
+
+    return (
+        buffer,
+        np.asarray(offsets, dtype=np.int64),
+        tuple(ids_encabezados),
+        np.asarray(ids_encabezado, dtype=np.int32),
+    )
+
+
+def construir_almacen_pasajes(
+    pasajes: Iterable[dict[str, str]],
+    titulo: str = "",
+    nombre: str = NOMBRE_CORPUS_QUIJOTE,
+) -> AlmacenPasajes:
+    return AlmacenPasajes(
+        *empaquetar_textos(
+            (pasaje["encabezado"], pasaje["texto"]) for pasaje in pasajes
+        ),
+        titulo=titulo,
+        nombre=nombre,
+    )
+
+
+def construir_almacen_chunks(
+    chunks: Iterable[tuple[str, str, int, int]],
+    titulo: str = "",
+    nombre: str = NOMBRE_CORPUS_QUIJOTE,
+) -> AlmacenChunks:
+    inicios: list[int] = []
+    fines: list[int] = []
+
+    def separar_rangos() -> Iterator[tuple[str, str]]:
+        for encabezado, texto, inicio, fin in chunks:
+            inicios.append(inicio)
+            fines.append(fin)
+            yield encabezado, texto
+
+    buffer, offsets, encabezados, ids_encabezado = empaquetar_textos(separar_rangos())
+    return AlmacenChunks(
+        buffer,
+        offsets,
+        encabezados,
+        ids_encabezado,
+        np.asarray(inicios, dtype=np.int32),
+        np.asarray(fines, dtype=np.int32),
+        titulo=titulo,
+        nombre=nombre,
+    )
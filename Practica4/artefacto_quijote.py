@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import mmap
+import sys
+import sysconfig
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from almacen_pasajes import (
+    NOMBRE_CORPUS_QUIJOTE,
+    AlmacenPasajes,
+    codificar_textos,
+    decodificar_textos,
+)
+from postings_comprimidos import PostingsComprimidos
+from busqueda_semantica import (
+    LIMITE_BENCHMARK_IVF,
+    MODELO_EMBEDDINGS,
+    construir_chunks_semanticos,
+    construir_indice_semantico,
+    generar_embeddings_mezcla,
+    informar_progreso_embeddings,
+    medir_indice_ivf,
+    obtener_distribuidor_embeddings,
+)
+from buscar_quijote import (
+    RUTA_QUIJOTE,
+    CorpusLematizado,
+    IndiceClasico,
+    buscar_candidatos_and,
+    comprobar_lematizador_rapido,
+    construir_indice_clasico,
+    extraer_pasajes,
+    obtener_version_nlp,
+    registrar_indice_clasico,
+)
+
+
+MAGIA_ARTEFACTO = b"FDIPLNQ\x00"
+VERSION_ARTEFACTO = 4
+ALINEACION = 64
+NOMBRE_ARTEFACTO = "indice_quijote.bin"
+MAXIMO_DISCREPANCIAS = 10
+CONSULTAS_ESTADISTICAS = 200
+LEMAS_FRECUENTES_ESTADISTICAS = 1000
+CONSULTAS_BENCHMARK_IVF = 500
+
+
+def obtener_ruta_artefacto() -> Path:
+    candidatas = [
+        Path(__file__).resolve().with_name(NOMBRE_ARTEFACTO),
+        Path.cwd() / NOMBRE_ARTEFACTO,
+        Path(sysconfig.get_paths().get("data", "")) / NOMBRE_ARTEFACTO,
+        Path(sys.prefix) / NOMBRE_ARTEFACTO,
+    ]
+
+    for candidata in candidatas:
+        if candidata.exists():
+            return candidata
+
+    return candidatas[0]
+
+
+def calcular_hash_archivo(ruta: Path) -> str:
+    resumen = hashlib.sha256()
+
+    with ruta.open("rb") as archivo:
+        for bloque in iter(lambda: archivo.read(1 << 20), b""):
+            resumen.update(bloque)
+
+    return resumen.hexdigest()
+
+
+def describir_postings(
+    prefijo: str, postings: PostingsComprimidos
+) -> dict[str, np.ndarray]:
+    return {
+        f"{prefijo}_datos": postings.datos,
+        f"{prefijo}_bytes_indptr": postings.bytes_indptr,
+        f"{prefijo}_longitudes": postings.longitudes,
+        f"{prefijo}_saltos_valores": postings.saltos_valores,
+        f"{prefijo}_saltos_bytes": postings.saltos_bytes,
+    }
+
+
+def leer_postings(
+    arrays: dict[str, np.ndarray], prefijo: str, dtype: type
+) -> PostingsComprimidos:
+    return PostingsComprimidos(
+        arrays[f"{prefijo}_datos"],
+        arrays[f"{prefijo}_bytes_indptr"],
+        arrays[f"{prefijo}_longitudes"],
+        arrays[f"{prefijo}_saltos_valores"],
+        arrays[f"{prefijo}_saltos_bytes"],
+        dtype,
+    )
+
+
+def guardar_artefacto(ruta: Path, indice: IndiceClasico, hash_html: str) -> None:
+    pasajes = indice.pasajes
+    buffer_encabezados, offsets_encabezados = codificar_textos(pasajes.encabezados)
+    buffer_vocabulario, offsets_vocabulario = codificar_textos(indice.vocabulario)
+    arrays = {
+        "textos": np.frombuffer(pasajes.buffer, dtype=np.uint8),
+        "offsets_textos": pasajes.offsets,
+        "encabezados": buffer_encabezados,
+        "offsets_encabezados": offsets_encabezados,
+        "ids_encabezado": pasajes.ids_encabezado,
+        "hashes_pasajes": indice.hashes_pasajes,
+        "vocabulario": buffer_vocabulario,
+        "offsets_vocabulario": offsets_vocabulario,
+        "tokens_indptr": indice.corpus.indptr,
+        "tokens_lemmas": indice.corpus.lemmas,
+        "tokens_inicios": indice.corpus.inicios,
+        "tokens_fines": indice.corpus.fines,
+        "tokens_posiciones": indice.corpus.posiciones,
+        "indptr": indice.indptr,
+        "indices": indice.indices,
+        "datos": indice.datos,
+        "datos_bm25": indice.datos_bm25,
+        "idf": indice.idf,
+        "frecuencias": indice.frecuencias,
+        **describir_postings("postings", indice.postings),
+        **describir_postings("posiciones", indice.posiciones),
+    }
+    descripcion: dict[str, dict[str, object]] = {}
+    desplazamiento = 0
+
+    for nombre, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[nombre] = array
+        descripcion[nombre] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": desplazamiento,
+        }
+        desplazamiento += -(-array.nbytes // ALINEACION) * ALINEACION
+
+    cabecera = json.dumps(
+        {
+            "version": VERSION_ARTEFACTO,
+            "hash_html": hash_html,
+            "version_nlp": obtener_version_nlp(),
+            "titulo": pasajes.titulo,
+            "nombre": pasajes.nombre,
+            "arrays": descripcion,
+        }
+    ).encode("utf-8")
+    inicio_datos = -(-(len(MAGIA_ARTEFACTO) + 8 + len(cabecera)) // ALINEACION)
+    inicio_datos *= ALINEACION
+    temporal = ruta.with_suffix(ruta.suffix + ".tmp")
+
+    with temporal.open("wb") as archivo:
+        archivo.write(MAGIA_ARTEFACTO)
+        archivo.write(len(cabecera).to_bytes(8, "little"))
+        archivo.write(cabecera)
+
+        for nombre, array in arrays.items():
+            archivo.seek(inicio_datos + int(descripcion[nombre]["offset"]))
+            archivo.write(array.tobytes())
+
+        archivo.truncate(inicio_datos + desplazamiento)
+
+    temporal.replace(ruta)
+
+
+def leer_cabecera_artefacto(mapa: mmap.mmap) -> tuple[dict[str, object], int]:
+    if mapa[: len(MAGIA_ARTEFACTO)] != MAGIA_ARTEFACTO:
+        raise ValueError("El archivo no es un indice del Quijote.")
+
+    inicio_cabecera = len(MAGIA_ARTEFACTO) + 8
+    largo_cabecera = int.from_bytes(
+        mapa[len(MAGIA_ARTEFACTO) : inicio_cabecera], "little"
+    )
+    cabecera = json.loads(mapa[inicio_cabecera : inicio_cabecera + largo_cabecera])
+    inicio_datos = -(-(inicio_cabecera + largo_cabecera) // ALINEACION) * ALINEACION
+    return cabecera, inicio_datos
+
+
+def cargar_artefacto(ruta: Path) -> tuple[dict[str, object], IndiceClasico]:
+    with ruta.open("rb") as archivo:
+        mapa = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+
+    cabecera, inicio_datos = leer_cabecera_artefacto(mapa)
+    arrays: dict[str, np.ndarray] = {}
+
+    for nombre, descripcion in dict(cabecera["arrays"]).items():
+        forma = tuple(descripcion["shape"])
+        arrays[nombre] = np.frombuffer(
+            mapa,
+            dtype=np.dtype(descripcion["dtype"]),
+            count=int(np.prod(forma)),
+            offset=inicio_datos + int(descripcion["offset"]),
+        ).reshape(forma)
+
+    pasajes = AlmacenPasajes(
+        arrays["textos"],
+        arrays["offsets_textos"],
+        tuple(decodificar_textos(arrays["encabezados"], arrays["offsets_encabezados"])),
+        arrays["ids_encabezado"],
+        titulo=str(cabecera.get("titulo", "")),
+        nombre=str(cabecera.get("nombre", NOMBRE_CORPUS_QUIJOTE)),
+    )
+    corpus = CorpusLematizado(
+        tuple(decodificar_textos(arrays["vocabulario"], arrays["offsets_vocabulario"])),
+        arrays["tokens_indptr"],
+        arrays["tokens_lemmas"],
+        arrays["tokens_inicios"],
+        arrays["tokens_fines"],
+        arrays["tokens_posiciones"],
+    )
+    indice = IndiceClasico(
+        pasajes,
+        corpus,
+        arrays["indptr"],
+        arrays["indices"],
+        arrays["datos"],
+        arrays["idf"],
+        arrays["frecuencias"],
+        postings=leer_postings(arrays, "postings", np.int32),
+        datos_bm25=arrays["datos_bm25"],
+        posiciones=leer_postings(arrays, "posiciones", np.int64),
+        hashes_pasajes=arrays["hashes_pasajes"],
+    )
+    return cabecera, indice
+
+
+def artefacto_vigente(cabecera: dict[str, object], hash_html: str | None) -> bool:
+    if cabecera.get("version") != VERSION_ARTEFACTO:
+        return False
+    if cabecera.get("version_nlp") != obtener_version_nlp():
+        return False
+    return hash_html is None or cabecera.get("hash_html") == hash_html
+
+
+def cargar_artefacto_compatible(
+    ruta: Path,
+) -> tuple[dict[str, object], IndiceClasico] | None:
+    if not ruta.exists():
+        return None
+
+    try:
+        cabecera, indice = cargar_artefacto(ruta)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if not artefacto_vigente(cabecera, None):
+        return None
+    return cabecera, indice
+
+
+def cargar_indice_quijote(
+    ruta_html: Path = RUTA_QUIJOTE,
+    ruta_artefacto: Path | None = None,
+    guardar: bool = False,
+) -> IndiceClasico | None:
+    ruta_artefacto = ruta_artefacto or obtener_ruta_artefacto()
+    hash_html = calcular_hash_archivo(ruta_html) if ruta_html.exists() else None
+    compatible = cargar_artefacto_compatible(ruta_artefacto)
+    previo = None
+
+    if compatible is not None:
+        cabecera, previo = compatible
+        if artefacto_vigente(cabecera, hash_html):
+            registrar_indice_clasico(previo)
+            return previo
+
+    if hash_html is None:
+        return None
+
+    indice = construir_indice_clasico(extraer_pasajes(ruta_html), previo=previo)
+    if guardar:
+        try:
+            guardar_artefacto(ruta_artefacto, indice, hash_html)
+        except OSError:
+            pass
+
+    registrar_indice_clasico(indice)
+    return indice
+
+
+def medir_memoria_conjuntos(postings: PostingsComprimidos) -> tuple[list[set], int]:
+    tracemalloc.start()
+    conjuntos = [
+        set(postings.obtener_fila(fila).tolist()) for fila in range(len(postings))
+    ]
+    memoria = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return conjuntos, memoria
+
+
+def elegir_consultas_estadisticas(
+    indice: IndiceClasico, consultas: int = CONSULTAS_ESTADISTICAS
+) -> list[tuple[int, int]]:
+    frecuentes = np.argsort(-indice.frecuencia_documental, kind="stable")[
+        :LEMAS_FRECUENTES_ESTADISTICAS
+    ]
+    generador = np.random.default_rng(0)
+    return [
+        tuple(generador.choice(frecuentes, size=2, replace=False).tolist())
+        for _ in range(consultas)
+    ]
+
+
+def informar_postings(
+    nombre: str, postings: PostingsComprimidos, tamano_valor: int
+) -> list[set]:
+    conjuntos, memoria_conjuntos = medir_memoria_conjuntos(postings)
+    memoria_plana = (
+        int(postings.longitudes.sum()) * tamano_valor + (len(postings) + 1) * 8
+    )
+    print(
+        f"{nombre}: {int(postings.longitudes.sum())} entradas; conjuntos de Python "
+        f"{memoria_conjuntos} bytes, arrays {memoria_plana} bytes, comprimidos "
+        f"{postings.calcular_memoria()} bytes."
+    )
+    return conjuntos
+
+
+def informar_intersecciones(indice: IndiceClasico, conjuntos: list[set]) -> None:
+    consultas = elegir_consultas_estadisticas(indice)
+    lemmas = [
+        frozenset(indice.vocabulario[id_lemma] for id_lemma in consulta)
+        for consulta in consultas
+    ]
+
+    coincidencias = 0
+    inicio = time.perf_counter()
+    for id_a, id_b in consultas:
+        coincidencias += len(conjuntos[id_a] & conjuntos[id_b])
+    tiempo_conjuntos = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    for consulta in lemmas:
+        coincidencias -= len(buscar_candidatos_and(indice, consulta))
+    tiempo_comprimidos = time.perf_counter() - inicio
+
+    if coincidencias:
+        raise RuntimeError("Los postings comprimidos no coinciden con los conjuntos.")
+    print(
+        f"AND de {len(consultas)} pares de lemas frecuentes: conjuntos de Python "
+        f"{tiempo_conjuntos / len(consultas) * 1e6:.1f} us por consulta, "
+        f"postings comprimidos {tiempo_comprimidos / len(consultas) * 1e6:.1f} us "
+        "por consulta."
+    )
+
+
+def informar_estadisticas(indice: IndiceClasico) -> None:
+    pasajes = indice.pasajes
+    chunks = construir_chunks_semanticos(pasajes)
+    print(
+        f"Almacen de pasajes: {len(pasajes)} pasajes, "
+        f"{pasajes.calcular_memoria()} bytes."
+    )
+    print(
+        f"Almacen de chunks: {len(chunks)} chunks, {chunks.calcular_memoria()} bytes."
+    )
+    conjuntos = informar_postings("Postings de documentos", indice.postings, 4)
+    informar_postings("Postings posicionales", indice.posiciones, 8)
+    informar_intersecciones(indice, conjuntos)
+
+
+def informar_benchmark_ivf(pasajes: AlmacenPasajes, filas: int, consultas: int) -> None:
+    _, embeddings = construir_indice_semantico(
+        pasajes, progreso=informar_progreso_embeddings
+    )
+    reales = np.asarray(embeddings, dtype=np.float32)
+    embeddings = reales
+    if filas > len(reales):
+        embeddings = np.concatenate(
+            [reales, generar_embeddings_mezcla(reales, filas - len(reales), semilla=1)]
+        )
+
+    indice, tiempo_construccion, velocidad_exacta, medidas = medir_indice_ivf(
+        embeddings, generar_embeddings_mezcla(reales, consultas, semilla=2)
+    )
+    print(
+        f"IVF sobre {embeddings.shape[0]} x {embeddings.shape[1]}: {len(indice)} "
+        f"listas, construido en {tiempo_construccion:.2f} s. Busqueda exacta: "
+        f"{velocidad_exacta:.0f} consultas/s."
+    )
+    for nprobe, recall, velocidad in medidas:
+        print(
+            f"  nprobe {nprobe:3d}: recall@{LIMITE_BENCHMARK_IVF} {recall:.3f}, "
+            f"{velocidad:.0f} consultas/s ({velocidad / velocidad_exacta:.1f}x)."
+        )
+
+
+def parsear_argumentos(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Construye el indice binario de pasajes del Quijote"
+    )
+    parser.add_argument(
+        "--html", type=Path, default=RUTA_QUIJOTE, help="HTML del corpus"
+    )
+    parser.add_argument(
+        "--salida",
+        type=Path,
+        default=Path(__file__).resolve().with_name(NOMBRE_ARTEFACTO),
+        help="Ruta del indice generado",
+    )
+    parser.add_argument(
+        "--reconstruir",
+        action="store_true",
+        help="Reconstruye el indice aunque el guardado siga vigente",
+    )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Genera tambien la cache de embeddings que falte o haya cambiado",
+    )
+    parser.add_argument(
+        "--comprobar-lematizador",
+        action="store_true",
+        help="Compara el lematizador rapido con spaCy en todo el vocabulario",
+    )
+    parser.add_argument(
+        "--estadisticas",
+        action="store_true",
+        help="Muestra la memoria que ocupan las estructuras del indice",
+    )
+    parser.add_argument(
+        "--benchmark-ivf",
+        action="store_true",
+        help="Compara el indice IVF con la busqueda exacta (recall y consultas/s)",
+    )
+    parser.add_argument(
+        "--chunks-benchmark",
+        type=int,
+        default=0,
+        help="Completa los embeddings con mezclas sinteticas hasta este numero de filas",
+    )
+    parser.add_argument(
+        "--consultas-benchmark",
+        type=int,
+        default=CONSULTAS_BENCHMARK_IVF,
+        help="Consultas sinteticas del benchmark IVF",
+    )
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    argumentos = parsear_argumentos(sys.argv[1:])
+    compatible = cargar_artefacto_compatible(argumentos.salida)
+    hash_html = calcular_hash_archivo(argumentos.html)
+
+    if (
+        compatible is not None
+        and artefacto_vigente(compatible[0], hash_html)
+        and not argumentos.reconstruir
+    ):
+        indice = compatible[1]
+        pasajes = indice.pasajes
+        registrar_indice_clasico(indice)
+        accion = "vigente"
+    else:
+        pasajes = extraer_pasajes(argumentos.html)
+        indice = construir_indice_clasico(
+            pasajes, previo=compatible[1] if compatible is not None else None
+        )
+        guardar_artefacto(argumentos.salida, indice, hash_html)
+        accion = "guardado"
+
+    print(
+        f"Indice {accion} en {argumentos.salida}: {len(pasajes)} pasajes, "
+        f"{len(indice.vocabulario)} lemas, {argumentos.salida.stat().st_size} bytes."
+    )
+
+    if argumentos.estadisticas:
+        informar_estadisticas(indice)
+
+    if argumentos.embeddings:
+        chunks, embeddings = construir_indice_semantico(
+            pasajes, progreso=informar_progreso_embeddings
+        )
+        print(
+            f"Embeddings de {MODELO_EMBEDDINGS}: {len(chunks)} chunks de dimension "
+            f"{embeddings.shape[1]}."
+        )
+        print(f"Servidores: {obtener_distribuidor_embeddings().describir()}.")
+
+    if argumentos.benchmark_ivf:
+        informar_benchmark_ivf(
+            pasajes, argumentos.chunks_benchmark, argumentos.consultas_benchmark
+        )
+
+    if argumentos.comprobar_lematizador:
+        discrepancias = comprobar_lematizador_rapido(pasajes)
+        for texto in discrepancias[:MAXIMO_DISCREPANCIAS]:
+            print(f"Discrepancia: {texto[:80]!r}")
+        print(f"Lematizador rapido: {len(discrepancias)} discrepancias con spaCy.")
+        if discrepancias:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
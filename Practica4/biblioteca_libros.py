@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from almacen_pasajes import AlmacenPasajes
+from artefacto_quijote import cargar_indice_quijote
+from buscar_quijote import obtener_nombre_libro
+
+
+PROCESOS_BIBLIOTECA = int(
+    os.getenv("FDI_PLN_P4_PROCESOS_BIBLIOTECA", str(os.cpu_count() or 1))
+)
+EXTENSIONES_LIBROS = (".htm", ".html")
+
+_libros_proceso: tuple[AlmacenPasajes, ...] = ()
+
+
+def listar_libros(directorio: Path) -> list[Path]:
+    return sorted(
+        ruta
+        for ruta in directorio.iterdir()
+        if ruta.is_file() and ruta.suffix.lower() in EXTENSIONES_LIBROS
+    )
+
+
+def obtener_ruta_artefacto_libro(ruta_html: Path) -> Path:
+    return ruta_html.with_name(f"indice_{obtener_nombre_libro(ruta_html)}.bin")
+
+
+def cargar_libro(ruta_html: Path) -> AlmacenPasajes:
+    indice = cargar_indice_quijote(
+        ruta_html, obtener_ruta_artefacto_libro(ruta_html), guardar=True
+    )
+    if indice is None:
+        raise FileNotFoundError(ruta_html)
+    return indice.pasajes
+
+
+def inicializar_proceso_libros(rutas: tuple[Path, ...]) -> None:
+    global _libros_proceso
+
+    _libros_proceso = tuple(cargar_libro(ruta) for ruta in rutas)
+
+
+def ejecutar_en_libro(posicion: int, funcion: Callable, argumentos: tuple) -> object:
+    return funcion(_libros_proceso[posicion], *argumentos)
+
+
+class BibliotecaLibros:
+    def __init__(
+        self,
+        rutas: tuple[Path, ...],
+        libros: tuple[AlmacenPasajes, ...],
+        procesos: int = PROCESOS_BIBLIOTECA,
+    ) -> None:
+        self.rutas = rutas
+        self.libros = libros
+        self.procesos = max(1, min(procesos, len(libros)))
+        self.ejecutores: list[ProcessPoolExecutor] = []
+
+    def __len__(self) -> int:
+        return sum(len(libro) for libro in self.libros)
+
+    @property
+    def titulos(self) -> tuple[str, ...]:
+        return tuple(libro.titulo for libro in self.libros)
+
+    def obtener_ejecutores(self) -> list[ProcessPoolExecutor]:
+        if not self.ejecutores:
+            contexto = multiprocessing.get_context("spawn")
+            self.ejecutores = [
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=contexto,
+                    initializer=inicializar_proceso_libros,
+                    initargs=(self.rutas[proceso :: self.procesos],),
+                )
+                for proceso in range(self.procesos)
+            ]
+        return self.ejecutores
+
+    def repartir(self, funcion: Callable, *argumentos: object) -> list:
+        if self.procesos == 1:
+            return [funcion(libro, *argumentos) for libro in self.libros]
+
+        ejecutores = self.obtener_ejecutores()
+        futuros = [
+            ejecutores[posicion % self.procesos].submit(
+                ejecutar_en_libro, posicion // self.procesos, funcion, argumentos
+            )
+            for posicion in range(len(self.libros))
+        ]
+        return [futuro.result() for futuro in futuros]
+
+    def cerrar(self) -> None:
+        for ejecutor in self.ejecutores:
+            ejecutor.shutdown(cancel_futures=True)
+        self.ejecutores = []
+
+
+def cargar_biblioteca(
+    directorio: Path, procesos: int = PROCESOS_BIBLIOTECA
+) -> BibliotecaLibros | None:
+    rutas = tuple(listar_libros(directorio)) if directorio.is_dir() else ()
+    if not rutas:
+        return None
+
+    return BibliotecaLibros(
+        rutas, tuple(cargar_libro(ruta) for ruta in rutas), procesos=procesos
+    )
@@ -1,26 +1,76 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
 import html
+import os
 import re
 import sys
 import sysconfig
-from collections import Counter
+from collections import Counter, OrderedDict
+from collections.abc import Iterator
 from functools import lru_cache
+from importlib import metadata
 from pathlib import Path
-from nltk.text import TextCollection
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from almacen_pasajes import (
+    NOMBRE_CORPUS_QUIJOTE,
+    AlmacenPasajes,
+    Pasaje,
+    construir_almacen_pasajes,
+)
+from lematizador_rapido import obtener_lematizador_rapido
+from postings_comprimidos import PostingsComprimidos, comprimir_postings
+from trigramas_lemas import IndiceTrigramas, construir_indice_trigramas
 
 try:
     import spacy
 except ImportError:  # pragma: no cover - depende del entorno
     spacy = None
 
+if TYPE_CHECKING:
+    from biblioteca_libros import BibliotecaLibros
+
 
 LIMITE_RESULTADOS = 5
+RANKING_TFIDF = "tfidf"
+RANKING_BM25 = "bm25"
+BM25_K1 = 1.5
+BM25_B = 0.75
+TAMANO_LOTE_LEMAS = 256
+PROCESOS_LEMAS = int(os.getenv("FDI_PLN_P4_PROCESOS_LEMAS", "1"))
+CAPACIDAD_BITSETS = int(os.getenv("FDI_PLN_P4_CAPACIDAD_BITSETS", "1024"))
 PATRON_BLOQUES = re.compile(
     r"<h3\b[^>]*>.*?</h3>|<p\b[^>]*>.*?</p>",
     re.IGNORECASE | re.DOTALL,
 )
 PATRON_ETIQUETAS = re.compile(r"<[^>]+>")
+PATRON_APERTURAS = re.compile(r"<(?:h3|p)\b", re.IGNORECASE)
+PATRON_TITULO = re.compile(r"<title\b[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+PREFIJO_TITULO_GUTENBERG = re.compile(
+    r"^the project gutenberg e-?book of\s+", re.IGNORECASE
+)
+TAMANO_LECTURA_HTML = 1 << 16
+PATRON_CONSULTA = re.compile(r'"([^"]*)"?|NEAR/([^\s"()]*)|[()]|[^\s"()]+')
+MAXIMA_DISTANCIA_CERCA = 1 << 31
+NODO_TERMINO = "termino"
+NODO_FRASE = "frase"
+NODO_CERCA = "cerca"
+NODO_Y = "y"
+NODO_O = "o"
+NODO_NO = "no"
+PIEZA_ABRE = "("
+PIEZA_CIERRA = ")"
+OPERADORES_CONSULTA = {
+    "AND": NODO_Y,
+    "OR": NODO_O,
+    "NOT": NODO_NO,
+    PIEZA_ABRE: PIEZA_ABRE,
+    PIEZA_CIERRA: PIEZA_CIERRA,
+}
 
 
 def obtener_ruta_quijote() -> Path:
@@ -50,6 +100,25 @@ def obtener_ruta_quijote() -> Path:
 RUTA_QUIJOTE = obtener_ruta_quijote()
 
 
+def obtener_nombre_libro(ruta_html: Path) -> str:
+    if ruta_html.name == RUTA_QUIJOTE.name:
+        return NOMBRE_CORPUS_QUIJOTE
+
+    return "".join(
+        caracter if caracter.isalnum() or caracter in "._-" else "_"
+        for caracter in ruta_html.stem
+    )
+
+
+def extraer_titulo_libro(ruta_html: Path) -> str:
+    with ruta_html.open(encoding="utf-8", errors="replace") as archivo:
+        coincidencia = PATRON_TITULO.search(archivo.read(TAMANO_LECTURA_HTML))
+
+    titulo = limpiar_html(coincidencia.group(1)) if coincidencia else ""
+    titulo = PREFIJO_TITULO_GUTENBERG.sub("", titulo).split(", by ")[0].strip()
+    return titulo or ruta_html.stem
+
+
 def limpiar_html(fragmento: str) -> str:
     fragmento = (
         fragmento.replace("<br />", " ").replace("<br/>", " ").replace("<br>", " ")
@@ -72,19 +141,101 @@ def obtener_nlp():
     return nlp
 
 
-@lru_cache(maxsize=6000)
-def obtener_lista_lemmas_significativos(texto: str) -> tuple[str, ...]:
-    doc = obtener_nlp()(texto)
-    lemmas: list[str] = []
+def extraer_tokens_significativos(doc) -> list[tuple[str, int, int, int]]:
+    tokens: list[tuple[str, int, int, int]] = []
+    posicion = 0
 
     for token in doc:
-        if not token.is_alpha or token.is_stop:
+        if not token.is_alpha:
             continue
+        if not token.is_stop:
+            lemma = token.lemma_.strip().lower() or token.lower_
+            tokens.append((lemma, token.idx, token.idx + len(token.text), posicion))
+        posicion += 1
+
+    return tokens
+
+
+def obtener_tokens_significativos(texto: str) -> list[tuple[str, int, int, int]]:
+    return extraer_tokens_significativos(obtener_nlp()(texto))
+
+
+def lematizar_pasajes(
+    textos: list[str],
+    tamano_lote: int = TAMANO_LOTE_LEMAS,
+    procesos: int = PROCESOS_LEMAS,
+) -> list[list[tuple[str, int, int, int]]]:
+    docs = obtener_nlp().pipe(textos, batch_size=tamano_lote, n_process=procesos)
+    return [extraer_tokens_significativos(doc) for doc in docs]
+
+
+@lru_cache(maxsize=1)
+def obtener_version_nlp() -> str:
+    versiones = [f"spacy={spacy.__version__ if spacy is not None else '-'}"]
+
+    try:
+        versiones.append(f"spacy-lookups-data={metadata.version('spacy-lookups-data')}")
+    except metadata.PackageNotFoundError:
+        versiones.append("spacy-lookups-data=-")
+
+    return ";".join(versiones)
+
+
+def calcular_clave_corpus(textos: list[str]) -> str:
+    resumen = hashlib.sha256(obtener_version_nlp().encode("utf-8"))
+
+    for texto in textos:
+        resumen.update(b"\0")
+        resumen.update(texto.encode("utf-8"))
+
+    return resumen.hexdigest()
 
-        lemma = token.lemma_.strip().lower() or token.lower_
-        lemmas.append(lemma)
 
-    return tuple(lemmas)
+def comprobar_lematizador_rapido(
+    pasajes: AlmacenPasajes,
+    tamano_lote: int = TAMANO_LOTE_LEMAS,
+) -> list[str]:
+    lematizador = obtener_lematizador_rapido()
+    textos = list(pasajes.iterar_textos())
+    formas: set[str] = set()
+    discrepancias: list[str] = []
+
+    for texto, doc in zip(textos, obtener_nlp().pipe(textos, batch_size=tamano_lote)):
+        formas.update(token.text for token in doc)
+        if extraer_tokens_significativos(doc) != (
+            lematizador.obtener_tokens_significativos(texto)
+        ):
+            discrepancias.append(texto)
+
+    for forma in sorted(formas):
+        if obtener_tokens_significativos(forma) != (
+            lematizador.obtener_tokens_significativos(forma)
+        ):
+            discrepancias.append(forma)
+
+    return discrepancias
+
+
+def obtener_ruta_cache_lemmas(clave: str) -> Path:
+    archivo = f"lemmas_quijote_{clave[:16]}.npz"
+    candidatas = [
+        Path(__file__).resolve().with_name(archivo),
+        Path.cwd() / archivo,
+        Path(sysconfig.get_paths().get("data", "")) / archivo,
+        Path(sys.prefix) / archivo,
+    ]
+
+    for candidata in candidatas:
+        if candidata.exists():
+            return candidata
+
+    return Path.cwd() / archivo
+
+
+@lru_cache(maxsize=6000)
+def obtener_lista_lemmas_significativos(texto: str) -> tuple[str, ...]:
+    tokens = obtener_lematizador_rapido().obtener_tokens_significativos(texto)
+    return tuple(lemma for lemma, _, _, _ in tokens)
 
 
 @lru_cache(maxsize=6000)
@@ -92,74 +243,872 @@ def obtener_lemmas_significativos(texto: str) -> frozenset[str]:
     return frozenset(obtener_lista_lemmas_significativos(texto))
 
 
-@lru_cache(maxsize=1)
-def construir_indice_tfidf(textos_normalizados: tuple[tuple[str, ...], ...]):
-    if TextCollection is None:
-        raise RuntimeError(
-            "NLTK no esta disponible. Ejecuta `uv sync` en Practica4 para instalar las dependencias."
+class ConsultaAnalizada:
+    def __init__(
+        self,
+        texto: str,
+        arbol: tuple | None,
+        con_operadores: bool,
+        lemmas: tuple[str, ...] = (),
+    ) -> None:
+        self.texto = texto
+        self.arbol = arbol
+        self.con_operadores = con_operadores
+        self.lemmas = lemmas
+
+    def tiene_operadores(self) -> bool:
+        return self.con_operadores and self.arbol is not None
+
+
+def obtener_patron_posicional(texto: str) -> tuple[tuple[str, int], ...]:
+    tokens = obtener_lematizador_rapido().obtener_tokens_significativos(texto)
+    if not tokens:
+        return ()
+
+    primera = tokens[0][3]
+    return tuple((lemma, posicion - primera) for lemma, _, _, posicion in tokens)
+
+
+def leer_distancia_cerca(texto: str) -> int:
+    if not (texto.isascii() and texto.isdigit()):
+        raise ValueError(
+            f"Distancia no valida en NEAR/{texto}: debe ser un entero no negativo."
+        )
+
+    cifras = texto.lstrip("0")
+    if len(cifras) > len(str(MAXIMA_DISTANCIA_CERCA)):
+        return MAXIMA_DISTANCIA_CERCA
+    return min(int(cifras or "0"), MAXIMA_DISTANCIA_CERCA)
+
+
+def dividir_consulta(consulta: str) -> list[tuple[str, str]]:
+    piezas: list[tuple[str, str]] = []
+
+    for coincidencia in PATRON_CONSULTA.finditer(consulta):
+        frase, distancia = coincidencia.groups()
+        pieza = coincidencia.group(0)
+        if frase is not None:
+            piezas.append((NODO_FRASE, frase))
+        elif distancia is not None:
+            piezas.append((NODO_CERCA, str(leer_distancia_cerca(distancia))))
+        elif pieza in OPERADORES_CONSULTA:
+            piezas.append((OPERADORES_CONSULTA[pieza], pieza))
+        else:
+            piezas.append((NODO_TERMINO, pieza))
+
+    return piezas
+
+
+class AnalizadorConsulta:
+    def __init__(self, piezas: list[tuple[str, str]]) -> None:
+        self.piezas = piezas
+        self.posicion = 0
+        self.textos: list[str] = []
+        self.lemmas: dict[str, None] = {}
+        self.negaciones = 0
+        self.con_operadores = False
+
+    def ver(self) -> str | None:
+        if self.posicion >= len(self.piezas):
+            return None
+        return self.piezas[self.posicion][0]
+
+    def consumir(self) -> tuple[str, str]:
+        pieza = self.piezas[self.posicion]
+        self.posicion += 1
+        if pieza[0] not in (NODO_TERMINO, NODO_FRASE):
+            self.con_operadores = True
+        return pieza
+
+    def describir_termino_ausente(self) -> str:
+        if self.posicion >= len(self.piezas):
+            return "Falta un termino al final de la consulta."
+
+        tipo, pieza = self.piezas[self.posicion]
+        if tipo == NODO_CERCA:
+            pieza = f"NEAR/{pieza}"
+        return f"Falta un termino antes de {pieza}."
+
+    def analizar(self) -> tuple | None:
+        nodos: list[tuple] = []
+
+        while self.ver() is not None:
+            if self.ver() == PIEZA_CIERRA:
+                raise ValueError("Sobra un parentesis de cierre.")
+            nodo = self.analizar_o()
+            if nodo is not None:
+                nodos.append(nodo)
+
+        return combinar_nodos(NODO_Y, nodos)
+
+    def analizar_o(self) -> tuple | None:
+        nodos = [self.analizar_y()]
+
+        while self.ver() == NODO_O:
+            self.consumir()
+            nodos.append(self.analizar_y())
+
+        return combinar_nodos(NODO_O, [nodo for nodo in nodos if nodo is not None])
+
+    def analizar_y(self) -> tuple | None:
+        nodos = [self.analizar_no()]
+
+        while self.ver() not in (None, NODO_O, PIEZA_CIERRA):
+            if self.ver() == NODO_Y:
+                self.consumir()
+            nodos.append(self.analizar_no())
+
+        return combinar_nodos(NODO_Y, [nodo for nodo in nodos if nodo is not None])
+
+    def analizar_no(self) -> tuple | None:
+        if self.ver() != NODO_NO:
+            return self.analizar_cerca()
+
+        self.consumir()
+        self.negaciones += 1
+        nodo = self.analizar_no()
+        self.negaciones -= 1
+        return (NODO_NO, nodo) if nodo is not None else None
+
+    def analizar_cerca(self) -> tuple | None:
+        izquierda = self.analizar_primario()
+        nodos = [izquierda]
+
+        while self.ver() == NODO_CERCA:
+            distancia = int(self.consumir()[1])
+            derecha = self.analizar_primario()
+            if any(
+                nodo is not None and nodo[0] not in (NODO_TERMINO, NODO_FRASE)
+                for nodo in (izquierda, derecha)
+            ):
+                raise ValueError(
+                    f"NEAR/{distancia} solo admite terminos o frases a ambos lados, "
+                    "no grupos entre parentesis."
+                )
+            if izquierda is not None and derecha is not None:
+                nodos[-1] = (NODO_CERCA, izquierda[1], derecha[1], distancia)
+                nodos.append(None)
+            else:
+                nodos.append(derecha)
+            izquierda = derecha
+
+        return combinar_nodos(NODO_Y, [nodo for nodo in nodos if nodo is not None])
+
+    def analizar_primario(self) -> tuple | None:
+        tipo = self.ver()
+        if tipo == PIEZA_ABRE:
+            self.consumir()
+            nodo = self.analizar_o()
+            if self.ver() != PIEZA_CIERRA:
+                raise ValueError("Falta un parentesis de cierre.")
+            self.consumir()
+            return nodo
+        if tipo not in (NODO_TERMINO, NODO_FRASE):
+            raise ValueError(self.describir_termino_ausente())
+
+        _, texto = self.consumir()
+        patron = obtener_patron_posicional(texto)
+        if not patron:
+            return None
+        self.lemmas.update((lemma, None) for lemma, _ in patron)
+        if self.negaciones % 2 == 0:
+            self.textos.append(texto)
+        if tipo == NODO_FRASE and len(patron) > 1:
+            self.con_operadores = True
+            return NODO_FRASE, patron
+        return NODO_TERMINO, patron
+
+
+def combinar_nodos(tipo: str, nodos: list[tuple]) -> tuple | None:
+    if not nodos:
+        return None
+    if len(nodos) == 1:
+        return nodos[0]
+    return tipo, tuple(nodos)
+
+
+@lru_cache(maxsize=6000)
+def analizar_consulta(consulta: str) -> ConsultaAnalizada:
+    analizador = AnalizadorConsulta(dividir_consulta(consulta))
+    arbol = analizador.analizar()
+    return ConsultaAnalizada(
+        " ".join(analizador.textos),
+        arbol,
+        analizador.con_operadores,
+        tuple(analizador.lemmas),
+    )
+
+
+class CorpusLematizado:
+    def __init__(
+        self,
+        vocabulario: tuple[str, ...],
+        indptr: np.ndarray,
+        lemmas: np.ndarray,
+        inicios: np.ndarray,
+        fines: np.ndarray,
+        posiciones: np.ndarray,
+    ) -> None:
+        self.vocabulario = vocabulario
+        self.indptr = indptr
+        self.lemmas = lemmas
+        self.inicios = inicios
+        self.fines = fines
+        self.posiciones = posiciones
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def obtener_tokens(
+        self, id_pasaje: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        inicio, fin = self.indptr[id_pasaje : id_pasaje + 2]
+        return self.lemmas[inicio:fin], self.inicios[inicio:fin], self.fines[inicio:fin]
+
+
+class IndiceClasico:
+    def __init__(
+        self,
+        pasajes: AlmacenPasajes,
+        corpus: CorpusLematizado,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        datos: np.ndarray,
+        idf: np.ndarray,
+        frecuencias: np.ndarray,
+        postings: PostingsComprimidos | None = None,
+        datos_bm25: np.ndarray | None = None,
+        posiciones: PostingsComprimidos | None = None,
+        hashes_pasajes: np.ndarray | None = None,
+    ) -> None:
+        self.pasajes = pasajes
+        self.corpus = corpus
+        self.hashes_pasajes = (
+            hashes_pasajes if hashes_pasajes is not None else pasajes.calcular_hashes()
+        )
+        self.vocabulario = corpus.vocabulario
+        self.ids_lemma = {
+            lemma: id_lemma for id_lemma, lemma in enumerate(self.vocabulario)
+        }
+        self.indptr = indptr
+        self.indices = indices
+        self.datos = datos
+        self.idf = idf
+        self.frecuencias = frecuencias
+        self.longitudes = np.diff(corpus.indptr)
+        self.longitud_media = (
+            float(self.longitudes.mean()) if self.longitudes.size else 0.0
+        )
+
+        if postings is None:
+            orden = np.argsort(indices, kind="stable")
+            postings_docs = np.repeat(
+                np.arange(len(pasajes), dtype=np.int32), np.diff(indptr)
+            )[orden]
+            postings_indptr = np.zeros(len(self.vocabulario) + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(indices, minlength=len(self.vocabulario)),
+                out=postings_indptr[1:],
+            )
+            postings = comprimir_postings(postings_indptr, postings_docs)
+        self.postings = postings
+        self.frecuencia_documental = postings.longitudes
+
+        self.bits_posicion = max(int(corpus.posiciones.max(initial=0)).bit_length(), 1)
+        self.mascara_posicion = (1 << self.bits_posicion) - 1
+
+        if posiciones is None:
+            orden = np.argsort(corpus.lemmas, kind="stable")
+            docs_tokens = np.repeat(
+                np.arange(len(pasajes), dtype=np.int64), self.longitudes
+            )
+            posiciones_claves = (
+                (docs_tokens << self.bits_posicion) | corpus.posiciones
+            )[orden]
+            posiciones_indptr = np.zeros(len(self.vocabulario) + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(corpus.lemmas, minlength=len(self.vocabulario)),
+                out=posiciones_indptr[1:],
+            )
+            posiciones = comprimir_postings(posiciones_indptr, posiciones_claves)
+        self.posiciones = posiciones
+        self.bitset_todos = np.packbits(np.ones(len(pasajes), dtype=bool))
+        self.bitsets: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.indice_trigramas: IndiceTrigramas | None = None
+        self.expansiones: dict[str, tuple[str, ...]] = {}
+        self.datos_bm25 = (
+            datos_bm25 if datos_bm25 is not None else calcular_pesos_bm25(self)
+        )
+
+    def obtener_indice_trigramas(self) -> IndiceTrigramas:
+        if self.indice_trigramas is None:
+            self.indice_trigramas = construir_indice_trigramas(
+                self.vocabulario, self.frecuencia_documental
+            )
+        return self.indice_trigramas
+
+    def obtener_expansiones(self, lemma: str) -> tuple[str, ...]:
+        if lemma in self.ids_lemma:
+            return ()
+        if lemma not in self.expansiones:
+            self.expansiones[lemma] = self.obtener_indice_trigramas().buscar_cercanos(
+                lemma
+            )
+        return self.expansiones[lemma]
+
+    def obtener_ids_lemma(self, lemma: str) -> list[int]:
+        id_lemma = self.ids_lemma.get(lemma)
+        if id_lemma is not None:
+            return [id_lemma]
+        return [self.ids_lemma[cercano] for cercano in self.obtener_expansiones(lemma)]
+
+    def contar_postings(self, lemma: str) -> int:
+        return sum(
+            int(self.frecuencia_documental[id_lemma])
+            for id_lemma in self.obtener_ids_lemma(lemma)
+        )
+
+    def obtener_postings(self, lemma: str) -> np.ndarray:
+        listas = [
+            self.postings.obtener_fila(id_lemma)
+            for id_lemma in self.obtener_ids_lemma(lemma)
+        ]
+        if not listas:
+            return np.empty(0, dtype=np.int32)
+        if len(listas) == 1:
+            return listas[0]
+        return np.unique(np.concatenate(listas))
+
+    def intersectar_postings(self, candidatos: np.ndarray, lemma: str) -> np.ndarray:
+        listas = [
+            self.postings.intersectar(candidatos, id_lemma)
+            for id_lemma in self.obtener_ids_lemma(lemma)
+        ]
+        if not listas:
+            return candidatos[:0]
+        if len(listas) == 1:
+            return listas[0]
+        return np.unique(np.concatenate(listas))
+
+    def empaquetar_docs(self, docs: np.ndarray) -> np.ndarray:
+        marcas = np.zeros(len(self.pasajes), dtype=bool)
+        marcas[docs] = True
+        return np.packbits(marcas)
+
+    def obtener_bitset(self, lemma: str) -> np.ndarray:
+        bits = self.bitsets.get(lemma)
+        if bits is None:
+            bits = self.empaquetar_docs(self.obtener_postings(lemma))
+            self.bitsets[lemma] = bits
+            while len(self.bitsets) > CAPACIDAD_BITSETS:
+                self.bitsets.popitem(last=False)
+        else:
+            self.bitsets.move_to_end(lemma)
+        return bits
+
+    def obtener_posiciones(self, lemma: str) -> np.ndarray:
+        listas = [
+            self.posiciones.obtener_fila(id_lemma)
+            for id_lemma in self.obtener_ids_lemma(lemma)
+        ]
+        if not listas:
+            return np.empty(0, dtype=np.int64)
+        if len(listas) == 1:
+            return listas[0]
+        return np.sort(np.concatenate(listas))
+
+
+def calcular_pesos_bm25(
+    indice: IndiceClasico, k1: float = BM25_K1, b: float = BM25_B
+) -> np.ndarray:
+    frecuencia_documental = indice.frecuencia_documental
+    idf = np.log1p(
+        (len(indice.pasajes) - frecuencia_documental + 0.5)
+        / (frecuencia_documental + 0.5)
+    )
+    filas = np.repeat(np.arange(len(indice.pasajes)), np.diff(indice.indptr))
+    normalizacion = k1 * (
+        1 - b + b * indice.longitudes[filas] / max(indice.longitud_media, 1e-9)
+    )
+    frecuencias = indice.frecuencias.astype(np.float64)
+    return idf[indice.indices] * frecuencias * (k1 + 1) / (frecuencias + normalizacion)
+
+
+def guardar_cache_lemmas(ruta: Path, clave: str, corpus: CorpusLematizado) -> None:
+    np.savez(
+        ruta,
+        clave=np.asarray(clave),
+        vocabulario=np.asarray(corpus.vocabulario, dtype=str),
+        indptr=corpus.indptr,
+        lemmas=corpus.lemmas,
+        inicios=corpus.inicios,
+        fines=corpus.fines,
+        posiciones=corpus.posiciones,
+    )
+
+
+def cargar_cache_lemmas(ruta: Path, clave: str) -> CorpusLematizado | None:
+    if not ruta.exists():
+        return None
+
+    with np.load(ruta) as datos:
+        if str(datos["clave"]) != clave or "posiciones" not in datos.files:
+            return None
+
+        return CorpusLematizado(
+            tuple(datos["vocabulario"].tolist()),
+            datos["indptr"],
+            datos["lemmas"],
+            datos["inicios"],
+            datos["fines"],
+            datos["posiciones"],
+        )
+
+
+def expandir_rangos(inicios: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    desplazamientos = np.cumsum(longitudes) - longitudes
+    return np.arange(int(longitudes.sum())) + np.repeat(
+        inicios - desplazamientos, longitudes
+    )
+
+
+def construir_corpus_lematizado(
+    tokens_pasajes: list[list[tuple[str, int, int, int]]],
+) -> CorpusLematizado:
+    vocabulario = tuple(
+        sorted({lemma for tokens in tokens_pasajes for lemma, _, _, _ in tokens})
+    )
+    ids_lemma = {lemma: id_lemma for id_lemma, lemma in enumerate(vocabulario)}
+    indptr = np.zeros(len(tokens_pasajes) + 1, dtype=np.int64)
+    np.cumsum([len(tokens) for tokens in tokens_pasajes], out=indptr[1:])
+    total_tokens = int(indptr[-1])
+
+    return CorpusLematizado(
+        vocabulario,
+        indptr,
+        np.fromiter(
+            (
+                ids_lemma[lemma]
+                for tokens in tokens_pasajes
+                for lemma, _, _, _ in tokens
+            ),
+            dtype=np.int32,
+            count=total_tokens,
+        ),
+        np.fromiter(
+            (inicio for tokens in tokens_pasajes for _, inicio, _, _ in tokens),
+            dtype=np.int32,
+            count=total_tokens,
+        ),
+        np.fromiter(
+            (fin for tokens in tokens_pasajes for _, _, fin, _ in tokens),
+            dtype=np.int32,
+            count=total_tokens,
+        ),
+        np.fromiter(
+            (posicion for tokens in tokens_pasajes for _, _, _, posicion in tokens),
+            dtype=np.int32,
+            count=total_tokens,
+        ),
+    )
+
+
+def combinar_corpus(
+    fuentes: tuple[CorpusLematizado, ...], origenes: np.ndarray, filas: np.ndarray
+) -> CorpusLematizado:
+    longitudes = np.zeros(len(filas), dtype=np.int64)
+    for id_fuente, fuente in enumerate(fuentes):
+        seleccion = origenes == id_fuente
+        longitudes[seleccion] = np.diff(fuente.indptr)[filas[seleccion]]
+
+    indptr = np.zeros(len(filas) + 1, dtype=np.int64)
+    np.cumsum(longitudes, out=indptr[1:])
+    rangos: list[tuple[np.ndarray, np.ndarray]] = []
+    lemmas_usados: set[str] = set()
+
+    for id_fuente, fuente in enumerate(fuentes):
+        seleccion = np.flatnonzero(origenes == id_fuente)
+        tokens_fuente = expandir_rangos(
+            fuente.indptr[filas[seleccion]], longitudes[seleccion]
         )
+        tokens_destino = expandir_rangos(indptr[seleccion], longitudes[seleccion])
+        rangos.append((tokens_fuente, tokens_destino))
+        lemmas_usados.update(
+            fuente.vocabulario[id_lemma]
+            for id_lemma in np.unique(fuente.lemmas[tokens_fuente]).tolist()
+        )
+
+    vocabulario = tuple(sorted(lemmas_usados))
+    ids_lemma = {lemma: id_lemma for id_lemma, lemma in enumerate(vocabulario)}
+    total_tokens = int(indptr[-1])
+    lemmas = np.empty(total_tokens, dtype=np.int32)
+    inicios = np.empty(total_tokens, dtype=np.int32)
+    fines = np.empty(total_tokens, dtype=np.int32)
+    posiciones = np.empty(total_tokens, dtype=np.int32)
+
+    for fuente, (tokens_fuente, tokens_destino) in zip(fuentes, rangos):
+        traduccion = np.asarray(
+            [ids_lemma.get(lemma, -1) for lemma in fuente.vocabulario], dtype=np.int32
+        )
+        lemmas[tokens_destino] = traduccion[fuente.lemmas[tokens_fuente]]
+        inicios[tokens_destino] = fuente.inicios[tokens_fuente]
+        fines[tokens_destino] = fuente.fines[tokens_fuente]
+        posiciones[tokens_destino] = fuente.posiciones[tokens_fuente]
+
+    return CorpusLematizado(vocabulario, indptr, lemmas, inicios, fines, posiciones)
+
+
+def actualizar_corpus_lematizado(
+    pasajes: AlmacenPasajes,
+    textos: list[str],
+    previo: IndiceClasico,
+    tamano_lote: int = TAMANO_LOTE_LEMAS,
+    procesos: int = PROCESOS_LEMAS,
+) -> CorpusLematizado:
+    filas_previas = {
+        hash_pasaje: fila
+        for fila, hash_pasaje in enumerate(previo.hashes_pasajes.tolist())
+    }
+    filas = np.fromiter(
+        (
+            filas_previas.get(hash_pasaje, -1)
+            for hash_pasaje in pasajes.calcular_hashes().tolist()
+        ),
+        dtype=np.int64,
+        count=len(pasajes),
+    )
+    pendientes = np.flatnonzero(filas < 0)
+    nuevos = construir_corpus_lematizado(
+        lematizar_pasajes(
+            [textos[indice] for indice in pendientes.tolist()],
+            tamano_lote=tamano_lote,
+            procesos=procesos,
+        )
+    )
+    origenes = (filas < 0).astype(np.int8)
+    filas[pendientes] = np.arange(len(pendientes))
+    return combinar_corpus((previo.corpus, nuevos), origenes, filas)
+
+
+def preprocesar_pasajes(
+    pasajes: AlmacenPasajes,
+    tamano_lote: int = TAMANO_LOTE_LEMAS,
+    procesos: int = PROCESOS_LEMAS,
+    usar_cache: bool = True,
+    previo: IndiceClasico | None = None,
+) -> CorpusLematizado:
+    textos = list(pasajes.iterar_textos())
+    clave = calcular_clave_corpus(textos)
+    ruta_cache = obtener_ruta_cache_lemmas(clave)
+
+    if usar_cache:
+        corpus = cargar_cache_lemmas(ruta_cache, clave)
+        if corpus is not None:
+            return corpus
+
+    if previo is not None:
+        corpus = actualizar_corpus_lematizado(
+            pasajes, textos, previo, tamano_lote=tamano_lote, procesos=procesos
+        )
+    else:
+        corpus = construir_corpus_lematizado(
+            lematizar_pasajes(textos, tamano_lote=tamano_lote, procesos=procesos)
+        )
+
+    if usar_cache:
+        try:
+            guardar_cache_lemmas(ruta_cache, clave, corpus)
+        except OSError:
+            pass
+
+    return corpus
+
+
+def construir_indice_clasico(
+    pasajes: AlmacenPasajes, previo: IndiceClasico | None = None
+) -> IndiceClasico:
+    corpus = preprocesar_pasajes(pasajes, previo=previo)
+    tamano_vocabulario = max(len(corpus.vocabulario), 1)
+    longitudes = np.diff(corpus.indptr)
+    docs_tokens = np.repeat(np.arange(len(pasajes), dtype=np.int64), longitudes)
+
+    claves, frecuencias = np.unique(
+        docs_tokens * tamano_vocabulario + corpus.lemmas, return_counts=True
+    )
+    filas = claves // tamano_vocabulario
+    indices = (claves % tamano_vocabulario).astype(np.int32)
+    indptr = np.zeros(len(pasajes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(filas, minlength=len(pasajes)), out=indptr[1:])
+
+    frecuencia_documental = np.bincount(indices, minlength=len(corpus.vocabulario))
+    idf = np.log(len(pasajes) / np.maximum(frecuencia_documental, 1))
+    tf = frecuencias / longitudes[filas]
+    datos = tf * idf[indices]
+
+    return IndiceClasico(
+        pasajes,
+        corpus,
+        indptr,
+        indices,
+        datos,
+        idf,
+        frecuencias.astype(np.int32),
+    )
+
+
+_indices_clasicos: dict[int, IndiceClasico] = {}
+
+
+def obtener_indice_clasico(pasajes: AlmacenPasajes) -> IndiceClasico:
+    indice = _indices_clasicos.get(id(pasajes))
+
+    if indice is None or indice.pasajes is not pasajes:
+        indice = construir_indice_clasico(pasajes)
+        registrar_indice_clasico(indice)
+
+    return indice
+
 
-    return TextCollection(textos_normalizados)
+def registrar_indice_clasico(indice: IndiceClasico) -> None:
+    _indices_clasicos[id(indice.pasajes)] = indice
 
 
-def obtener_scores_tfidf(pasajes: list[dict[str, str]], consulta: str) -> list[float]:
+def buscar_candidatos_and(
+    indice: IndiceClasico, lemmas_consulta: frozenset[str]
+) -> np.ndarray:
+    lemmas = sorted(lemmas_consulta, key=indice.contar_postings)
+    candidatos = indice.obtener_postings(lemmas[0])
+
+    for lemma in lemmas[1:]:
+        if not candidatos.size:
+            break
+        candidatos = indice.intersectar_postings(candidatos, lemma)
+
+    return candidatos
+
+
+def buscar_candidatos_or(
+    indice: IndiceClasico, lemmas_consulta: frozenset[str]
+) -> tuple[np.ndarray, np.ndarray]:
+    return np.unique(
+        np.concatenate([indice.obtener_postings(lemma) for lemma in lemmas_consulta]),
+        return_counts=True,
+    )
+
+
+def buscar_ocurrencias_patron(
+    indice: IndiceClasico, patron: tuple[tuple[str, int], ...]
+) -> np.ndarray:
+    listas = sorted(
+        (
+            (indice.obtener_posiciones(lemma), desplazamiento)
+            for lemma, desplazamiento in patron
+        ),
+        key=lambda lista: len(lista[0]),
+    )
+    mascara = indice.mascara_posicion
+    claves, desplazamiento = listas[0]
+    inicios = claves[(claves & mascara) >= desplazamiento] - desplazamiento
+
+    for claves, desplazamiento in listas[1:]:
+        inicios = inicios[(inicios & mascara) + desplazamiento <= mascara]
+        if not inicios.size or not claves.size:
+            return inicios[:0]
+        objetivos = inicios + desplazamiento
+        huecos = np.minimum(np.searchsorted(claves, objetivos), len(claves) - 1)
+        inicios = inicios[claves[huecos] == objetivos]
+
+    return inicios
+
+
+def buscar_ocurrencias_proximas(
+    indice: IndiceClasico,
+    patron_a: tuple[tuple[str, int], ...],
+    patron_b: tuple[tuple[str, int], ...],
+    distancia: int,
+) -> np.ndarray:
+    distancia = min(distancia, indice.mascara_posicion) + 1
+    inicios_a = buscar_ocurrencias_patron(indice, patron_a)
+    inicios_b = buscar_ocurrencias_patron(indice, patron_b)
+    documentos = inicios_a & ~indice.mascara_posicion
+    izquierda = np.searchsorted(
+        inicios_b,
+        np.maximum(inicios_a - patron_b[-1][1] - distancia, documentos),
+        side="left",
+    )
+    derecha = np.searchsorted(
+        inicios_b,
+        np.minimum(
+            inicios_a + patron_a[-1][1] + distancia,
+            documentos | indice.mascara_posicion,
+        ),
+        side="right",
+    )
+    return inicios_a[derecha > izquierda]
+
+
+def evaluar_consulta(indice: IndiceClasico, nodo: tuple) -> np.ndarray:
+    tipo = nodo[0]
+
+    if tipo == NODO_TERMINO:
+        bits = indice.bitset_todos
+
+        for lemma, _ in nodo[1]:
+            bits = bits & indice.obtener_bitset(lemma)
+
+        return bits
+    if tipo == NODO_FRASE:
+        inicios = buscar_ocurrencias_patron(indice, nodo[1])
+        return indice.empaquetar_docs(inicios >> indice.bits_posicion)
+    if tipo == NODO_CERCA:
+        inicios = buscar_ocurrencias_proximas(indice, nodo[1], nodo[2], nodo[3])
+        return indice.empaquetar_docs(inicios >> indice.bits_posicion)
+    if tipo == NODO_NO:
+        return ~evaluar_consulta(indice, nodo[1]) & indice.bitset_todos
+
+    resultados = [evaluar_consulta(indice, hijo) for hijo in nodo[1]]
+    operacion = np.bitwise_and if tipo == NODO_Y else np.bitwise_or
+    return operacion.reduce(resultados)
+
+
+def buscar_candidatos_booleanos(
+    indice: IndiceClasico, consulta: ConsultaAnalizada
+) -> np.ndarray:
+    bits = evaluar_consulta(indice, consulta.arbol)
+    return np.flatnonzero(np.unpackbits(bits, count=len(indice.pasajes))).astype(
+        np.int32
+    )
+
+
+def obtener_pesos_consulta(
+    indice: IndiceClasico, consulta: str, ranking: str = RANKING_TFIDF
+) -> np.ndarray:
     tokens_consulta = obtener_lista_lemmas_significativos(consulta)
-    if not tokens_consulta:
-        return [0.0] * len(pasajes)
+    pesos = np.zeros(len(indice.vocabulario), dtype=np.float64)
+
+    for termino, frecuencia in Counter(tokens_consulta).items():
+        ids_lemma = indice.obtener_ids_lemma(termino)
+        if ranking == RANKING_BM25:
+            pesos[ids_lemma] = frecuencia
+        else:
+            pesos[ids_lemma] = frecuencia / len(tokens_consulta)
+
+    return pesos
 
-    textos_normalizados = tuple(
-        obtener_lista_lemmas_significativos(pasaje["texto"]) for pasaje in pasajes
+
+def obtener_scores(
+    indice: IndiceClasico,
+    consulta: str,
+    candidatos: np.ndarray,
+    ranking: str = RANKING_TFIDF,
+) -> np.ndarray:
+    pesos_consulta = obtener_pesos_consulta(indice, consulta, ranking)
+    datos = indice.datos_bm25 if ranking == RANKING_BM25 else indice.datos
+    inicios = indice.indptr[candidatos]
+    longitudes = indice.indptr[candidatos + 1] - inicios
+    desplazamientos = np.cumsum(longitudes) - longitudes
+    posiciones = (
+        np.arange(int(longitudes.sum()))
+        - np.repeat(desplazamientos, longitudes)
+        + np.repeat(inicios, longitudes)
     )
-    coleccion = construir_indice_tfidf(textos_normalizados)
-    frecuencias_consulta = Counter(tokens_consulta)
-    total_terminos_consulta = len(tokens_consulta)
-    scores: list[float] = []
+    filas = np.repeat(np.arange(len(candidatos)), longitudes)
+    contribuciones = pesos_consulta[indice.indices[posiciones]] * datos[posiciones]
+    return np.bincount(filas, weights=contribuciones, minlength=len(candidatos))
+
+
+def obtener_scores_tfidf(
+    indice: IndiceClasico, consulta: str, candidatos: np.ndarray
+) -> np.ndarray:
+    return obtener_scores(indice, consulta, candidatos, RANKING_TFIDF)
+
+
+def seleccionar_mejores(
+    claves: list[tuple[float, ...]], limite: int | None
+) -> list[int]:
+    if limite is None or limite >= len(claves):
+        return sorted(range(len(claves)), key=claves.__getitem__)
+
+    return heapq.nsmallest(limite, range(len(claves)), key=claves.__getitem__)
 
-    for tokens_documento in textos_normalizados:
-        if not tokens_documento:
-            scores.append(0.0)
-            continue
 
-        score = 0.0
+def obtener_libros(
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+) -> tuple[AlmacenPasajes, ...]:
+    return (pasajes,) if isinstance(pasajes, AlmacenPasajes) else pasajes.libros
 
-        for termino, frecuencia in frecuencias_consulta.items():
-            peso_consulta = frecuencia / total_terminos_consulta
-            score += peso_consulta * coleccion.tf_idf(termino, tokens_documento)
 
-        scores.append(score)
+def obtener_expansiones_consulta(
+    pasajes: AlmacenPasajes | BibliotecaLibros, consulta: str
+) -> dict[str, tuple[str, ...]]:
+    indices = [obtener_indice_clasico(libro) for libro in obtener_libros(pasajes)]
+    expansiones: dict[str, tuple[str, ...]] = {}
 
-    return scores
+    for lemma in analizar_consulta(consulta).lemmas:
+        cercanos = {
+            cercano: None
+            for indice in indices
+            for cercano in indice.obtener_expansiones(lemma)
+        }
+        if cercanos:
+            expansiones[lemma] = tuple(cercanos)
+
+    return expansiones
 
 
 def obtener_rangos_lemmas_coincidentes(
-    texto: str, consulta: str
+    pasajes: AlmacenPasajes, id_pasaje: int, consulta: str
 ) -> list[tuple[int, int]]:
-    lemmas_consulta = obtener_lemmas_significativos(consulta)
+    lemmas_consulta = obtener_lemmas_significativos(analizar_consulta(consulta).texto)
     if not lemmas_consulta:
         return []
 
-    doc = obtener_nlp()(texto)
-    rangos: list[tuple[int, int]] = []
+    indice = obtener_indice_clasico(pasajes)
+    ids_consulta = [
+        id_lemma
+        for lemma in lemmas_consulta
+        for id_lemma in indice.obtener_ids_lemma(lemma)
+    ]
+    lemmas, inicios, fines = indice.corpus.obtener_tokens(id_pasaje)
+    coincidencias = np.isin(lemmas, ids_consulta)
+    return list(zip(inicios[coincidencias].tolist(), fines[coincidencias].tolist()))
 
-    for token in doc:
-        if not token.is_alpha or token.is_stop:
-            continue
 
-        lemma = token.lemma_.strip().lower() or token.lower_
-        if lemma in lemmas_consulta:
-            rangos.append((token.idx, token.idx + len(token.text)))
+def iterar_bloques_html(
+    ruta_html: Path, tamano_lectura: int = TAMANO_LECTURA_HTML
+) -> Iterator[str]:
+    pendiente = ""
 
-    return rangos
+    with ruta_html.open(encoding="utf-8") as archivo:
+        while True:
+            leido = archivo.read(tamano_lectura)
+            pendiente += leido
+            consumido = 0
 
+            for bloque in PATRON_BLOQUES.finditer(pendiente):
+                if leido and PATRON_APERTURAS.search(
+                    pendiente, consumido, bloque.start()
+                ):
+                    break
+                yield bloque.group(0)
+                consumido = bloque.end()
 
-def extraer_pasajes(ruta_html: Path) -> list[dict[str, str]]:
-    contenido = ruta_html.read_text(encoding="utf-8")
-    pasajes: list[dict[str, str]] = []
-    encabezado_actual = "Sin encabezado"
+            if not leido:
+                return
+
+            corte = len(pendiente) - 2
+            apertura = PATRON_APERTURAS.search(pendiente, consumido)
+            if apertura:
+                corte = min(corte, apertura.start())
+            pendiente = pendiente[max(consumido, corte) :]
 
-    for bloque in PATRON_BLOQUES.finditer(contenido):
-        texto_bloque = bloque.group(0)
 
+def iterar_pasajes(
+    ruta_html: Path, tamano_lectura: int = TAMANO_LECTURA_HTML
+) -> Iterator[dict[str, str]]:
+    encabezado_actual = "Sin encabezado"
+
+    for texto_bloque in iterar_bloques_html(ruta_html, tamano_lectura):
         if texto_bloque.lower().startswith("<h3"):
             encabezado_limpio = limpiar_html(texto_bloque)
             if encabezado_limpio:
@@ -168,36 +1117,90 @@ def extraer_pasajes(ruta_html: Path) -> list[dict[str, str]]:
 
         pasaje = limpiar_html(texto_bloque)
         if pasaje:
-            pasajes.append({"encabezado": encabezado_actual, "texto": pasaje})
+            yield {"encabezado": encabezado_actual, "texto": pasaje}
 
-    return pasajes
 
+def extraer_pasajes(ruta_html: Path) -> AlmacenPasajes:
+    return construir_almacen_pasajes(
+        iterar_pasajes(ruta_html),
+        titulo=extraer_titulo_libro(ruta_html),
+        nombre=obtener_nombre_libro(ruta_html),
+    )
 
-def buscar_pasajes_con_modo(
-    pasajes: list[dict[str, str]], consulta: str
-) -> tuple[list[dict[str, str]], str]:
-    lemmas_consulta = obtener_lemmas_significativos(consulta)
-    if not lemmas_consulta:
-        return [], "and"
 
-    scores_tfidf = obtener_scores_tfidf(pasajes, consulta)
-    exactos: list[tuple[float, int, dict[str, str]]] = []
-    parciales: list[tuple[int, float, int, dict[str, str]]] = []
+def buscar_claves_con_modo(
+    pasajes: AlmacenPasajes,
+    consulta: str,
+    limite: int | None = None,
+    ranking: str = RANKING_TFIDF,
+) -> tuple[list[tuple[float, ...]], str, int]:
+    analisis = analizar_consulta(consulta)
+    lemmas_consulta = obtener_lemmas_significativos(analisis.texto)
+    if not lemmas_consulta and not analisis.tiene_operadores():
+        return [], "and", 0
 
-    for indice, pasaje in enumerate(pasajes):
-        lemmas_pasaje = obtener_lemmas_significativos(pasaje["texto"])
+    indice = obtener_indice_clasico(pasajes)
+    if analisis.tiene_operadores():
+        exactos = buscar_candidatos_booleanos(indice, analisis)
+    else:
+        exactos = buscar_candidatos_and(indice, lemmas_consulta)
 
-        if lemmas_consulta.issubset(lemmas_pasaje):
-            exactos.append((scores_tfidf[indice], indice, pasaje))
-            continue
+    if exactos.size or analisis.tiene_operadores():
+        scores = obtener_scores(indice, analisis.texto, exactos, ranking)
+        claves = list(zip((-scores).tolist(), exactos.tolist()))
+        modo = "booleana" if analisis.tiene_operadores() else "and"
+    else:
+        parciales, coincidencias = buscar_candidatos_or(indice, lemmas_consulta)
+        scores = obtener_scores(indice, analisis.texto, parciales, ranking)
+        claves = list(
+            zip((-coincidencias).tolist(), (-scores).tolist(), parciales.tolist())
+        )
+        modo = "or"
+
+    mejores = seleccionar_mejores(claves, limite)
+    return [claves[i] for i in mejores], modo, len(claves)
 
-        coincidencias = len(lemmas_consulta & lemmas_pasaje)
-        if coincidencias:
-            parciales.append((coincidencias, scores_tfidf[indice], indice, pasaje))
 
-    if exactos:
-        exactos.sort(key=lambda item: (-item[0], item[1]))
-        return [pasaje for _, _, pasaje in exactos], "and"
+def buscar_pasajes_en_libros(
+    biblioteca: BibliotecaLibros,
+    consulta: str,
+    limite: int | None = None,
+    ranking: str = RANKING_TFIDF,
+) -> tuple[list[Pasaje], str, int]:
+    analisis = analizar_consulta(consulta)
+    if (
+        not obtener_lemmas_significativos(analisis.texto)
+        and not analisis.tiene_operadores()
+    ):
+        return [], "and", 0
+
+    respuestas = biblioteca.repartir(buscar_claves_con_modo, consulta, limite, ranking)
+    modos = [modo for _, modo, _ in respuestas if modo != "or"]
+    modo = modos[0] if modos else "or"
+    claves = [
+        (*clave[:-1], libro, clave[-1])
+        for libro, (mejores, modo_libro, _) in enumerate(respuestas)
+        if modo_libro == modo
+        for clave in mejores
+    ]
+    mejores = seleccionar_mejores(claves, limite)
+    resultados = [
+        Pasaje(biblioteca.libros[claves[i][-2]], claves[i][-1], -claves[i][-3])
+        for i in mejores
+    ]
+    total = sum(total for _, modo_libro, total in respuestas if modo_libro == modo)
+    return resultados, modo, total
+
+
+def buscar_pasajes_con_modo(
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    consulta: str,
+    limite: int | None = None,
+    ranking: str = RANKING_TFIDF,
+) -> tuple[list[Pasaje], str, int]:
+    if not isinstance(pasajes, AlmacenPasajes):
+        return buscar_pasajes_en_libros(pasajes, consulta, limite, ranking)
 
-    parciales.sort(key=lambda item: (-item[0], -item[1], item[2]))
-    return [pasaje for _, _, _, pasaje in parciales], "or"
+    claves, modo, total = buscar_claves_con_modo(pasajes, consulta, limite, ranking)
+    resultados = [Pasaje(pasajes, clave[-1], -clave[-2]) for clave in claves]
+    return resultados, modo, total
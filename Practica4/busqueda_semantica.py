@@ -1,34 +1,85 @@
 from __future__ import annotations
 
+import argparse
+import hashlib
+import heapq
+import json
 import os
 import sys
 import sysconfig
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import numpy as np
 import ollama
 
+from almacen_pasajes import (
+    NOMBRE_CORPUS_QUIJOTE,
+    AlmacenChunks,
+    AlmacenPasajes,
+    Chunk,
+    codificar_textos,
+    construir_almacen_chunks,
+    decodificar_textos,
+)
+from indice_ivf import (
+    NPROBE,
+    IndiceIVF,
+    cargar_indice_ivf,
+    construir_indice_ivf,
+)
+
+if TYPE_CHECKING:
+    from biblioteca_libros import BibliotecaLibros
+
 
 LIMITE_RESULTADOS = 5
 MODELO_EMBEDDINGS = os.getenv("FDI_PLN_P4_EMBED_MODEL", "nomic-embed-text:latest")
-TAMANO_LOTE = 1
+TAMANO_LOTE = int(os.getenv("FDI_PLN_P4_TAMANO_LOTE_EMBEDDINGS", "16"))
+PETICIONES_EMBEDDINGS = int(os.getenv("FDI_PLN_P4_PETICIONES_EMBEDDINGS", "4"))
+INTERVALO_CHECKPOINT = float(os.getenv("FDI_PLN_P4_INTERVALO_CHECKPOINT", "10"))
+HOSTS_OLLAMA = os.getenv("FDI_PLN_P4_OLLAMA_HOSTS", "")
+REINTENTOS_EMBEDDINGS = int(os.getenv("FDI_PLN_P4_REINTENTOS_EMBEDDINGS", "3"))
+ENFRIAMIENTO_SERVIDOR = float(os.getenv("FDI_PLN_P4_ENFRIAMIENTO_OLLAMA", "30"))
+ESPERA_REINTENTO = float(os.getenv("FDI_PLN_P4_ESPERA_REINTENTO_OLLAMA", "1"))
+CAPACIDAD_CACHE_CONSULTAS = int(
+    os.getenv("FDI_PLN_P4_CAPACIDAD_CACHE_CONSULTAS", "1024")
+)
+RUTA_CACHE_CONSULTAS = os.getenv("FDI_PLN_P4_CACHE_CONSULTAS", "")
+LOTE_CONSULTAS = 512
 TOKENS_POR_CHUNK = 512
 SOLAPE_TOKENS = TOKENS_POR_CHUNK // 4
+TIPO_EMBEDDINGS = np.dtype(os.getenv("FDI_PLN_P4_TIPO_EMBEDDINGS", "float32"))
+EXTENSION_EMBEDDINGS = ".npy"
+EXTENSION_METADATOS = ".chunks.npz"
+EXTENSION_EMBEDDINGS_NPZ = ".npz"
+EXTENSION_CHECKPOINT = ".parcial.npz"
+EXTENSION_IVF = ".ivf.npz"
+MINIMO_CHUNKS_IVF = int(os.getenv("FDI_PLN_P4_MINIMO_CHUNKS_IVF", "50000"))
+NPROBES_BENCHMARK_IVF = (1, 2, 4, 8, 16, 32, 64)
+LIMITE_BENCHMARK_IVF = 10
+RUIDO_BENCHMARK_IVF = 0.3
+VERSION_CACHE_EMBEDDINGS = 1
 
 
 def obtener_ruta_cache_embeddings(
     modelo: str = MODELO_EMBEDDINGS,
     tokens_por_chunk: int = TOKENS_POR_CHUNK,
     solape_tokens: int = SOLAPE_TOKENS,
+    nombre_corpus: str = NOMBRE_CORPUS_QUIJOTE,
+    extension: str = EXTENSION_EMBEDDINGS,
 ) -> Path:
     nombre = "".join(
         caracter if caracter.isalnum() or caracter in "._-" else "_"
         for caracter in modelo
     )
-    archivo = (
-        f"embeddings_quijote_{nombre}_tokens_{tokens_por_chunk}_{solape_tokens}.npz"
-    )
+    archivo = f"embeddings_{nombre_corpus}_{nombre}_tokens_{tokens_por_chunk}_{solape_tokens}{extension}"
     candidatas = [
         Path(__file__).resolve().with_name(archivo),
         Path.cwd() / archivo,
@@ -48,23 +99,23 @@ def obtener_ruta_cache_embeddings(
 
 
 def construir_capitulos(
-    pasajes: list[dict[str, str]],
-) -> list[dict[str, str | int]]:
-    if not pasajes:
+    pasajes: AlmacenPasajes,
+) -> list[dict[str, object]]:
+    if not len(pasajes):
         return []
 
-    capitulos: list[dict[str, str | int]] = []
-    encabezado_actual = pasajes[0]["encabezado"]
+    capitulos: list[dict[str, object]] = []
+    encabezado_actual = pasajes[0].encabezado
     inicio_actual = 0
-    pasajes_actuales: list[dict[str, str]] = []
+    pasajes_actuales: list[str] = []
 
     def cerrar_capitulo(fin_actual: int) -> None:
         palabras: list[str] = []
         rangos_pasajes: list[dict[str, int]] = []
         cursor = 0
 
-        for indice_pasaje, pasaje in enumerate(pasajes_actuales, start=inicio_actual):
-            palabras_pasaje = pasaje["texto"].split()
+        for indice_pasaje, texto in enumerate(pasajes_actuales, start=inicio_actual):
+            palabras_pasaje = texto.split()
             inicio_palabras = cursor
             cursor += len(palabras_pasaje)
             palabras.extend(palabras_pasaje)
@@ -87,14 +138,14 @@ def construir_capitulos(
         )
 
     for indice, pasaje in enumerate(pasajes):
-        if pasaje["encabezado"] != encabezado_actual and pasajes_actuales:
+        if pasaje.encabezado != encabezado_actual and pasajes_actuales:
             cerrar_capitulo(indice - 1)
-            encabezado_actual = pasaje["encabezado"]
+            encabezado_actual = pasaje.encabezado
             inicio_actual = indice
-            pasajes_actuales = [pasaje]
+            pasajes_actuales = [pasaje.texto]
             continue
 
-        pasajes_actuales.append(pasaje)
+        pasajes_actuales.append(pasaje.texto)
 
     if pasajes_actuales:
         cerrar_capitulo(len(pasajes) - 1)
@@ -128,13 +179,13 @@ def construir_chunks_de_capitulo(
     capitulo: dict[str, object],
     tokens_por_chunk: int,
     solape_tokens: int,
-) -> list[dict[str, str | int]]:
+) -> list[tuple[str, str, int, int]]:
     palabras = list(capitulo["palabras"])
     if not palabras:
         return []
 
     paso = max(1, tokens_por_chunk - solape_tokens)
-    chunks: list[dict[str, str | int]] = []
+    chunks: list[tuple[str, str, int, int]] = []
     rangos_pasajes = list(capitulo["rangos_pasajes"])
 
     for inicio in range(0, len(palabras), paso):
@@ -149,12 +200,12 @@ def construir_chunks_de_capitulo(
             fin_palabras=fin,
         )
         chunks.append(
-            {
-                "encabezado": str(capitulo["encabezado"]),
-                "texto": " ".join(palabras_chunk),
-                "inicio": inicio_pasaje,
-                "fin": fin_pasaje,
-            }
+            (
+                str(capitulo["encabezado"]),
+                " ".join(palabras_chunk),
+                inicio_pasaje,
+                fin_pasaje,
+            )
         )
 
         if fin >= len(palabras):
@@ -164,14 +215,11 @@ def construir_chunks_de_capitulo(
 
 
 def construir_chunks_por_tokens(
-    pasajes: list[dict[str, str]],
+    pasajes: AlmacenPasajes,
     tokens_por_chunk: int = TOKENS_POR_CHUNK,
     solape_tokens: int = SOLAPE_TOKENS,
-) -> list[dict[str, str | int]]:
-    if not pasajes:
-        return []
-
-    chunks: list[dict[str, str | int]] = []
+) -> AlmacenChunks:
+    chunks: list[tuple[str, str, int, int]] = []
 
     for capitulo in construir_capitulos(pasajes):
         chunks.extend(
@@ -182,14 +230,16 @@ def construir_chunks_por_tokens(
             )
         )
 
-    return chunks
+    return construir_almacen_chunks(
+        chunks, titulo=pasajes.titulo, nombre=pasajes.nombre
+    )
 
 
 def construir_chunks_semanticos(
-    pasajes: list[dict[str, str]],
+    pasajes: AlmacenPasajes,
     tokens_por_chunk: int = TOKENS_POR_CHUNK,
     solape_tokens: int = SOLAPE_TOKENS,
-) -> list[dict[str, str | int]]:
+) -> AlmacenChunks:
     return construir_chunks_por_tokens(
         pasajes,
         tokens_por_chunk=tokens_por_chunk,
@@ -197,9 +247,138 @@ def construir_chunks_semanticos(
     )
 
 
+class ServidorEmbeddings:
+    def __init__(self, host: str | None, limite: int = PETICIONES_EMBEDDINGS) -> None:
+        self.host = host
+        self.limite = max(1, limite)
+        self.cliente = ollama.Client(host=host)
+        self.activas = 0
+        self.lotes = 0
+        self.fallos = 0
+        self.fallos_seguidos = 0
+        self.pausado_hasta = 0.0
+
+    @property
+    def nombre(self) -> str:
+        return self.host or "ollama"
+
+
+class DistribuidorEmbeddings:
+    def __init__(
+        self,
+        servidores: list[ServidorEmbeddings],
+        reintentos: int = REINTENTOS_EMBEDDINGS,
+        enfriamiento: float = ENFRIAMIENTO_SERVIDOR,
+        espera_reintento: float = ESPERA_REINTENTO,
+    ) -> None:
+        self.servidores = servidores
+        self.reintentos = reintentos
+        self.enfriamiento = enfriamiento
+        self.espera_reintento = espera_reintento
+        self.condicion = threading.Condition()
+
+    @property
+    def capacidad(self) -> int:
+        return sum(servidor.limite for servidor in self.servidores)
+
+    def reservar(self, excluidos: set[int], espera: float = 0.0) -> ServidorEmbeddings:
+        limite_espera = time.monotonic() + espera
+
+        with self.condicion:
+            while True:
+                ahora = time.monotonic()
+                candidatos = [
+                    servidor
+                    for servidor in self.servidores
+                    if id(servidor) not in excluidos
+                ] or self.servidores
+                sanos = [
+                    servidor
+                    for servidor in candidatos
+                    if servidor.pausado_hasta <= ahora
+                ]
+                if not sanos and ahora >= limite_espera:
+                    sanos = [
+                        min(candidatos, key=lambda servidor: servidor.pausado_hasta)
+                    ]
+                libres = [
+                    servidor for servidor in sanos if servidor.activas < servidor.limite
+                ]
+                if libres:
+                    servidor = min(
+                        libres, key=lambda servidor: servidor.activas / servidor.limite
+                    )
+                    servidor.activas += 1
+                    return servidor
+                self.condicion.wait(timeout=0.1)
+
+    def liberar(self, servidor: ServidorEmbeddings, fallo: bool) -> None:
+        with self.condicion:
+            servidor.activas -= 1
+            if fallo:
+                servidor.fallos += 1
+                servidor.fallos_seguidos += 1
+                servidor.pausado_hasta = (
+                    time.monotonic()
+                    + self.enfriamiento * 2 ** min(servidor.fallos_seguidos - 1, 5)
+                )
+            else:
+                servidor.lotes += 1
+                servidor.fallos_seguidos = 0
+                servidor.pausado_hasta = 0.0
+            self.condicion.notify_all()
+
+    def embeber(self, modelo: str, textos: list[str]) -> np.ndarray:
+        excluidos: set[int] = set()
+        ultimo_error: Exception | None = None
+
+        for intento in range(self.reintentos + 1):
+            servidor = self.reservar(
+                excluidos,
+                self.espera_reintento * 2 ** (intento - 1) if intento else 0.0,
+            )
+            fallo = True
+            try:
+                respuesta = servidor.cliente.embed(model=modelo, input=textos)
+                fallo = False
+            except Exception as error:
+                excluidos.add(id(servidor))
+                ultimo_error = error
+                continue
+            finally:
+                self.liberar(servidor, fallo)
+
+            return np.asarray(respuesta.embeddings, dtype=np.float32)
+
+        raise ultimo_error
+
+    def describir(self) -> str:
+        ahora = time.monotonic()
+        return "; ".join(
+            f"{servidor.nombre}: {servidor.lotes} lotes, {servidor.fallos} fallos"
+            + (" (en pausa)" if servidor.pausado_hasta > ahora else "")
+            for servidor in self.servidores
+        )
+
+
+def parsear_hosts_ollama(
+    hosts: str, limite: int = PETICIONES_EMBEDDINGS
+) -> list[ServidorEmbeddings]:
+    servidores: list[ServidorEmbeddings] = []
+
+    for entrada in hosts.split(","):
+        host, _, limite_host = entrada.strip().partition("#")
+        if host:
+            servidores.append(
+                ServidorEmbeddings(host, int(limite_host) if limite_host else limite)
+            )
+
+    return servidores or [ServidorEmbeddings(None, limite)]
+
+
 @lru_cache(maxsize=1)
-def obtener_cliente_ollama() -> ollama.Client:
-    return ollama.Client()
+def obtener_distribuidor_embeddings() -> DistribuidorEmbeddings:
+    return DistribuidorEmbeddings(parsear_hosts_ollama(HOSTS_OLLAMA))
 
 
 def normalizar_embeddings(matriz: np.ndarray) -> np.ndarray:
@@ -218,51 +397,421 @@ def normalizar_consulta(vector: np.ndarray) -> np.ndarray:
     return vector / norma
 
 
+def obtener_ruta_checkpoint_embeddings(ruta: Path) -> Path:
+    return ruta.with_name(
+        ruta.name.removesuffix(EXTENSION_EMBEDDINGS) + EXTENSION_CHECKPOINT
+    )
+
+
+def obtener_ruta_ivf_embeddings(ruta: Path) -> Path:
+    return ruta.with_name(ruta.name.removesuffix(EXTENSION_EMBEDDINGS) + EXTENSION_IVF)
+
+
+def cargar_checkpoint_embeddings(
+    ruta: Path, modelo: str
+) -> tuple[np.ndarray, np.ndarray] | None:
+    if not ruta.exists():
+        return None
+
+    try:
+        with np.load(ruta, allow_pickle=False) as datos:
+            if str(datos["modelo"]) != modelo:
+                return None
+            return datos["hashes"], datos["embeddings"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def guardar_checkpoint_embeddings(
+    ruta: Path,
+    modelo: str,
+    hashes: np.ndarray,
+    filas: list[np.ndarray | None],
+) -> None:
+    completadas = [indice for indice, fila in enumerate(filas) if fila is not None]
+    if not completadas:
+        return
+
+    temporal = ruta.with_name(ruta.name + ".tmp")
+    with temporal.open("wb") as archivo:
+        np.savez(
+            archivo,
+            modelo=np.asarray(modelo),
+            hashes=hashes[completadas],
+            embeddings=np.vstack([filas[indice] for indice in completadas]),
+        )
+    temporal.replace(ruta)
+
+
+def informar_progreso_embeddings(
+    completados: int, total: int, chunks_por_segundo: float
+) -> None:
+    print(
+        f"\rEmbeddings: {completados}/{total} chunks, {chunks_por_segundo:.1f} chunks/s",
+        end="\n" if completados == total else "",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
 def generar_embeddings_textos(
     textos: list[str],
     modelo: str = MODELO_EMBEDDINGS,
     tamano_lote: int = TAMANO_LOTE,
+    distribuidor: DistribuidorEmbeddings | None = None,
+    hashes: np.ndarray | None = None,
+    ruta_checkpoint: Path | None = None,
+    progreso: Callable[[int, int, float], None] | None = None,
 ) -> np.ndarray:
     if not textos:
         return np.empty((0, 0), dtype=np.float32)
 
-    cliente = obtener_cliente_ollama()
-    lotes: list[np.ndarray] = []
+    filas: list[np.ndarray | None] = [None] * len(textos)
+    if hashes is None:
+        ruta_checkpoint = None
+    checkpoint = (
+        cargar_checkpoint_embeddings(ruta_checkpoint, modelo)
+        if ruta_checkpoint is not None
+        else None
+    )
+    if checkpoint is not None:
+        filas_checkpoint = {
+            hash_texto: fila for fila, hash_texto in enumerate(checkpoint[0].tolist())
+        }
+        for indice, hash_texto in enumerate(hashes.tolist()):
+            fila = filas_checkpoint.get(hash_texto)
+            if fila is not None:
+                filas[indice] = checkpoint[1][fila]
+
+    pendientes = [indice for indice, fila in enumerate(filas) if fila is None]
+    reanudados = len(textos) - len(pendientes)
+    completados = reanudados
+    distribuidor = distribuidor or obtener_distribuidor_embeddings()
+
+    def embeber_lote(lote: list[int]) -> np.ndarray:
+        return normalizar_embeddings(
+            distribuidor.embeber(modelo, [textos[indice] for indice in lote])
+        )
+
+    inicio = ultimo_checkpoint = time.perf_counter()
+    ejecutor = ThreadPoolExecutor(max_workers=distribuidor.capacidad)
+    try:
+        futuros = {
+            ejecutor.submit(embeber_lote, lote): lote
+            for lote in (
+                pendientes[posicion : posicion + tamano_lote]
+                for posicion in range(0, len(pendientes), max(1, tamano_lote))
+            )
+        }
+        for futuro in as_completed(futuros):
+            lote = futuros[futuro]
+            for indice, fila in zip(lote, futuro.result()):
+                filas[indice] = fila
+            completados += len(lote)
+
+            ahora = time.perf_counter()
+            if progreso is not None:
+                progreso(
+                    completados,
+                    len(textos),
+                    (completados - reanudados) / max(ahora - inicio, 1e-9),
+                )
+            if (
+                ruta_checkpoint is not None
+                and ahora - ultimo_checkpoint >= INTERVALO_CHECKPOINT
+            ):
+                guardar_checkpoint_embeddings(ruta_checkpoint, modelo, hashes, filas)
+                ultimo_checkpoint = ahora
+    except BaseException:
+        if ruta_checkpoint is not None:
+            guardar_checkpoint_embeddings(ruta_checkpoint, modelo, hashes, filas)
+        raise
+    finally:
+        ejecutor.shutdown(cancel_futures=True)
+
+    if ruta_checkpoint is not None:
+        ruta_checkpoint.unlink(missing_ok=True)
+    return np.vstack(filas)
+
+
+def normalizar_texto(consulta: str) -> str:
+    return " ".join(consulta.split())
+
+
+class CacheEmbeddingsConsulta:
+    def __init__(
+        self,
+        capacidad: int = CAPACIDAD_CACHE_CONSULTAS,
+        ruta: Path | None = None,
+    ) -> None:
+        self.capacidad = capacidad
+        self.ruta = ruta
+        self.entradas: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self.cerrojo = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+        if ruta is not None:
+            self.cargar()
+
+    def __len__(self) -> int:
+        return len(self.entradas)
+
+    def obtener(self, modelo: str, consulta: str) -> np.ndarray | None:
+        clave = (modelo, normalizar_texto(consulta))
+        with self.cerrojo:
+            vector = self.entradas.get(clave)
+            if vector is None:
+                self.fallos += 1
+                return None
+
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return vector
+
+    def guardar(self, modelo: str, consulta: str, vector: np.ndarray) -> None:
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        clave = (modelo, normalizar_texto(consulta))
+
+        with self.cerrojo:
+            self.entradas[clave] = vector
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.capacidad:
+                self.entradas.popitem(last=False)
+
+    def describir(self) -> str:
+        consultas = self.aciertos + self.fallos
+        tasa = 100 * self.aciertos / consultas if consultas else 0.0
+        return (
+            f"Embeddings de consulta: {self.aciertos} aciertos, {self.fallos} fallos "
+            f"({tasa:.0f}%)."
+        )
+
+    def cargar(self) -> None:
+        if self.ruta is None or not self.ruta.exists():
+            return
+
+        try:
+            with np.load(self.ruta, allow_pickle=False) as datos:
+                claves = json.loads(str(datos["claves"]))
+                offsets = datos["offsets"].tolist()
+                vectores = datos["vectores"]
+        except (OSError, ValueError, KeyError):
+            return
+
+        for (modelo, consulta), inicio, fin in list(
+            zip(claves, offsets[:-1], offsets[1:])
+        )[-self.capacidad :]:
+            self.guardar(modelo, consulta, vectores[inicio:fin])
+
+    def persistir(self) -> None:
+        if self.ruta is None:
+            return
+
+        with self.cerrojo:
+            entradas = list(self.entradas.items())
+        offsets = np.zeros(len(entradas) + 1, dtype=np.int64)
+        np.cumsum([len(vector) for _, vector in entradas], out=offsets[1:])
+        temporal = self.ruta.with_name(self.ruta.name + ".tmp")
+
+        try:
+            with temporal.open("wb") as archivo:
+                np.savez(
+                    archivo,
+                    claves=np.asarray(json.dumps([clave for clave, _ in entradas])),
+                    offsets=offsets,
+                    vectores=np.concatenate(
+                        [vector for _, vector in entradas]
+                        or [np.empty(0, dtype=np.float32)]
+                    ),
+                )
+            temporal.replace(self.ruta)
+        except OSError:
+            pass
 
-    for inicio in range(0, len(textos), tamano_lote):
-        lote = textos[inicio : inicio + tamano_lote]
-        respuesta = cliente.embed(model=modelo, input=lote)
-        lotes.append(np.asarray(respuesta.embeddings, dtype=np.float32))
 
-    return normalizar_embeddings(np.vstack(lotes))
+@lru_cache(maxsize=1)
+def obtener_cache_embeddings_consulta() -> CacheEmbeddingsConsulta:
+    return CacheEmbeddingsConsulta(
+        ruta=Path(RUTA_CACHE_CONSULTAS) if RUTA_CACHE_CONSULTAS else None
+    )
 
 
 def obtener_embedding_consulta(
     consulta: str,
     modelo: str = MODELO_EMBEDDINGS,
 ) -> np.ndarray:
-    cliente = obtener_cliente_ollama()
-    respuesta = cliente.embed(model=modelo, input=[consulta])
-    vector = np.asarray(respuesta.embeddings[0], dtype=np.float32)
-    return normalizar_consulta(vector)
+    cache = obtener_cache_embeddings_consulta()
+    vector = cache.obtener(modelo, consulta)
+    if vector is not None:
+        return vector
+
+    vector = normalizar_consulta(
+        obtener_distribuidor_embeddings().embeber(modelo, [consulta])[0]
+    )
+    cache.guardar(modelo, consulta, vector)
+    return vector
+
+
+def obtener_embeddings_consultas(
+    consultas: list[str],
+    modelo: str = MODELO_EMBEDDINGS,
+) -> np.ndarray:
+    cache = obtener_cache_embeddings_consulta()
+    vectores = [cache.obtener(modelo, consulta) for consulta in consultas]
+    pendientes = list(
+        dict.fromkeys(
+            normalizar_texto(consulta)
+            for consulta, vector in zip(consultas, vectores)
+            if vector is None
+        )
+    )
+
+    if pendientes:
+        nuevos = dict(
+            zip(pendientes, generar_embeddings_textos(pendientes, modelo=modelo))
+        )
+        for consulta, vector in nuevos.items():
+            cache.guardar(modelo, consulta, vector)
+        vectores = [
+            nuevos[normalizar_texto(consulta)] if vector is None else vector
+            for consulta, vector in zip(consultas, vectores)
+        ]
+
+    if not vectores:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.vstack(vectores).astype(np.float32, copy=False)
+
+
+def obtener_ruta_metadatos_embeddings(ruta: Path) -> Path:
+    return ruta.with_name(
+        ruta.name.removesuffix(EXTENSION_EMBEDDINGS) + EXTENSION_METADATOS
+    )
+
+
+def calcular_hash_raiz(hashes: np.ndarray) -> str:
+    return hashlib.blake2b(
+        np.ascontiguousarray(hashes, dtype=np.uint64).tobytes(), digest_size=16
+    ).hexdigest()
+
+
+def construir_manifiesto(
+    hashes: np.ndarray,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+    hash_pasajes: str = "",
+) -> dict[str, object]:
+    return {
+        "version": VERSION_CACHE_EMBEDDINGS,
+        "modelo": modelo,
+        "tokens_por_chunk": tokens_por_chunk,
+        "solape_tokens": solape_tokens,
+        "chunks": len(hashes),
+        "hash_raiz": calcular_hash_raiz(hashes),
+        "hash_pasajes": hash_pasajes,
+    }
+
+
+class CacheEmbeddings:
+    def __init__(
+        self,
+        chunks: AlmacenChunks,
+        embeddings: np.ndarray,
+        hashes: np.ndarray,
+        manifiesto: dict[str, object],
+    ) -> None:
+        self.chunks = chunks
+        self.embeddings = embeddings
+        self.hashes = hashes
+        self.manifiesto = manifiesto
+
+    def es_compatible(
+        self, modelo: str, tokens_por_chunk: int, solape_tokens: int
+    ) -> bool:
+        return (
+            self.manifiesto.get("version") == VERSION_CACHE_EMBEDDINGS
+            and self.manifiesto.get("modelo") == modelo
+            and self.manifiesto.get("tokens_por_chunk") == tokens_por_chunk
+            and self.manifiesto.get("solape_tokens") == solape_tokens
+        )
 
 
 def guardar_cache_embeddings(
-    ruta: Path, chunks: list[dict[str, str | int]], embeddings: np.ndarray
+    ruta: Path,
+    chunks: AlmacenChunks,
+    embeddings: np.ndarray,
+    manifiesto: dict[str, object],
+    hashes: np.ndarray | None = None,
+    tipo: np.dtype = TIPO_EMBEDDINGS,
 ) -> None:
-    np.savez_compressed(
-        ruta,
-        embeddings=embeddings.astype(np.float32),
-        encabezados=np.asarray([chunk["encabezado"] for chunk in chunks], dtype=object),
-        textos=np.asarray([chunk["texto"] for chunk in chunks], dtype=object),
-        inicios=np.asarray([chunk["inicio"] for chunk in chunks], dtype=np.int32),
-        fines=np.asarray([chunk["fin"] for chunk in chunks], dtype=np.int32),
-    )
+    buffer_encabezados, offsets_encabezados = codificar_textos(chunks.encabezados)
+    ruta_metadatos = obtener_ruta_metadatos_embeddings(ruta)
+    temporal_metadatos = ruta_metadatos.with_name(ruta_metadatos.name + ".tmp")
+    temporal = ruta.with_name(ruta.name + ".tmp")
+
+    with temporal_metadatos.open("wb") as archivo:
+        np.savez(
+            archivo,
+            manifiesto=np.asarray(json.dumps(manifiesto)),
+            hashes=chunks.calcular_hashes() if hashes is None else hashes,
+            textos=np.frombuffer(chunks.buffer, dtype=np.uint8),
+            offsets=chunks.offsets.astype(np.int64),
+            encabezados=buffer_encabezados,
+            offsets_encabezados=offsets_encabezados,
+            ids_encabezado=chunks.ids_encabezado.astype(np.int32),
+            inicios=chunks.inicios.astype(np.int32),
+            fines=chunks.fines.astype(np.int32),
+        )
+    with temporal.open("wb") as archivo:
+        np.save(archivo, np.ascontiguousarray(embeddings, dtype=tipo))
+
+    temporal_metadatos.replace(ruta_metadatos)
+    temporal.replace(ruta)
 
 
 def cargar_cache_embeddings(
     ruta: Path,
-) -> tuple[list[dict[str, str | int]], np.ndarray] | None:
+    titulo: str = "",
+    nombre: str = NOMBRE_CORPUS_QUIJOTE,
+) -> CacheEmbeddings | None:
+    ruta_metadatos = obtener_ruta_metadatos_embeddings(ruta)
+    if not ruta.exists() or not ruta_metadatos.exists():
+        return None
+
+    with np.load(ruta_metadatos, allow_pickle=False) as datos:
+        if "manifiesto" not in datos.files:
+            return None
+        manifiesto = json.loads(str(datos["manifiesto"]))
+        hashes = datos["hashes"]
+        chunks = AlmacenChunks(
+            datos["textos"],
+            datos["offsets"],
+            tuple(
+                decodificar_textos(datos["encabezados"], datos["offsets_encabezados"])
+            ),
+            datos["ids_encabezado"],
+            datos["inicios"],
+            datos["fines"],
+            titulo=titulo,
+            nombre=nombre,
+        )
+
+    embeddings = np.load(ruta, mmap_mode="r", allow_pickle=False)
+    if not len(embeddings) == len(chunks) == len(hashes) == manifiesto.get("chunks"):
+        return None
+    return CacheEmbeddings(chunks, embeddings, hashes, manifiesto)
+
+
+def cargar_cache_embeddings_npz(
+    ruta: Path,
+    titulo: str = "",
+    nombre: str = NOMBRE_CORPUS_QUIJOTE,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+) -> CacheEmbeddings | None:
     if not ruta.exists():
         return None
 
@@ -273,50 +822,151 @@ def cargar_cache_embeddings(
         inicios = datos["inicios"].tolist()
         fines = datos["fines"].tolist()
 
-    chunks = [
-        {
-            "encabezado": encabezado,
-            "texto": texto,
-            "inicio": int(inicio),
-            "fin": int(fin),
-        }
-        for encabezado, texto, inicio, fin in zip(encabezados, textos, inicios, fines)
-    ]
-    return chunks, embeddings
+    chunks = construir_almacen_chunks(
+        zip(encabezados, textos, inicios, fines), titulo=titulo, nombre=nombre
+    )
+    hashes = chunks.calcular_hashes()
+    return CacheEmbeddings(
+        chunks,
+        embeddings,
+        hashes,
+        construir_manifiesto(hashes, modelo, tokens_por_chunk, solape_tokens),
+    )
 
 
-def construir_indice_semantico(
-    pasajes: list[dict[str, str]],
+def convertir_cache_embeddings(
+    ruta_npz: Path,
+    ruta: Path | None = None,
+    tipo: np.dtype = TIPO_EMBEDDINGS,
     modelo: str = MODELO_EMBEDDINGS,
     tokens_por_chunk: int = TOKENS_POR_CHUNK,
     solape_tokens: int = SOLAPE_TOKENS,
-    regenerar: bool = False,
-) -> tuple[list[dict[str, str | int]], np.ndarray]:
-    chunks = construir_chunks_semanticos(
-        pasajes,
+) -> Path:
+    cache = cargar_cache_embeddings_npz(
+        ruta_npz,
+        modelo=modelo,
         tokens_por_chunk=tokens_por_chunk,
         solape_tokens=solape_tokens,
     )
+    if cache is None:
+        raise FileNotFoundError(ruta_npz)
+
+    ruta = ruta or ruta_npz.with_suffix(EXTENSION_EMBEDDINGS)
+    guardar_cache_embeddings(
+        ruta, cache.chunks, cache.embeddings, cache.manifiesto, cache.hashes, tipo=tipo
+    )
+    return ruta
+
+
+def actualizar_embeddings(
+    chunks: AlmacenChunks,
+    hashes: np.ndarray,
+    hashes_previos: np.ndarray,
+    embeddings_previos: np.ndarray,
+    modelo: str = MODELO_EMBEDDINGS,
+    ruta_checkpoint: Path | None = None,
+    progreso: Callable[[int, int, float], None] | None = None,
+) -> np.ndarray:
+    filas_previas = {
+        hash_chunk: fila for fila, hash_chunk in enumerate(hashes_previos.tolist())
+    }
+    filas = np.fromiter(
+        (filas_previas.get(hash_chunk, -1) for hash_chunk in hashes.tolist()),
+        dtype=np.int64,
+        count=len(chunks),
+    )
+    pendientes = np.flatnonzero(filas < 0)
+    embeddings = np.empty((len(chunks), embeddings_previos.shape[1]), dtype=np.float32)
+    reutilizadas = np.flatnonzero(filas >= 0)
+    embeddings[reutilizadas] = embeddings_previos[filas[reutilizadas]]
+
+    if pendientes.size:
+        embeddings[pendientes] = generar_embeddings_textos(
+            [chunks.obtener_texto(indice) for indice in pendientes.tolist()],
+            modelo=modelo,
+            hashes=hashes[pendientes],
+            ruta_checkpoint=ruta_checkpoint,
+            progreso=progreso,
+        )
+
+    return embeddings
+
+
+def construir_indice_semantico(
+    pasajes: AlmacenPasajes,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+    regenerar: bool = False,
+    progreso: Callable[[int, int, float], None] | None = None,
+) -> tuple[AlmacenChunks, np.ndarray]:
     ruta_cache = obtener_ruta_cache_embeddings(
         modelo,
         tokens_por_chunk=tokens_por_chunk,
         solape_tokens=solape_tokens,
+        nombre_corpus=pasajes.nombre,
     )
+    hash_pasajes = pasajes.calcular_hash()
+    cache = None
+
+    if regenerar:
+        obtener_ruta_checkpoint_embeddings(ruta_cache).unlink(missing_ok=True)
+    else:
+        cache = cargar_cache_embeddings(ruta_cache, pasajes.titulo, pasajes.nombre)
+        if cache is None:
+            cache = cargar_cache_embeddings_npz(
+                obtener_ruta_cache_embeddings(
+                    modelo,
+                    tokens_por_chunk=tokens_por_chunk,
+                    solape_tokens=solape_tokens,
+                    nombre_corpus=pasajes.nombre,
+                    extension=EXTENSION_EMBEDDINGS_NPZ,
+                ),
+                pasajes.titulo,
+                pasajes.nombre,
+                modelo=modelo,
+                tokens_por_chunk=tokens_por_chunk,
+                solape_tokens=solape_tokens,
+            )
+        if cache is not None and not cache.es_compatible(
+            modelo, tokens_por_chunk, solape_tokens
+        ):
+            cache = None
+        if cache is not None and cache.manifiesto.get("hash_pasajes") == hash_pasajes:
+            return cache.chunks, cache.embeddings
 
-    if not regenerar:
-        cache = cargar_cache_embeddings(ruta_cache)
-        if cache is not None:
-            chunks_cache, embeddings_cache = cache
-            if [chunk["texto"] for chunk in chunks_cache] == [
-                chunk["texto"] for chunk in chunks
-            ]:
-                return chunks_cache, embeddings_cache
-
-    embeddings = generar_embeddings_textos(
-        [str(chunk["texto"]) for chunk in chunks],
-        modelo=modelo,
+    chunks = construir_chunks_semanticos(
+        pasajes,
+        tokens_por_chunk=tokens_por_chunk,
+        solape_tokens=solape_tokens,
+    )
+    hashes = chunks.calcular_hashes()
+    manifiesto = construir_manifiesto(
+        hashes, modelo, tokens_por_chunk, solape_tokens, hash_pasajes
     )
-    guardar_cache_embeddings(ruta_cache, chunks, embeddings)
+
+    if cache is not None and manifiesto["hash_raiz"] == cache.manifiesto["hash_raiz"]:
+        embeddings = cache.embeddings
+    elif cache is not None and cache.embeddings.size:
+        embeddings = actualizar_embeddings(
+            chunks,
+            hashes,
+            cache.hashes,
+            cache.embeddings,
+            modelo=modelo,
+            ruta_checkpoint=obtener_ruta_checkpoint_embeddings(ruta_cache),
+            progreso=progreso,
+        )
+    else:
+        embeddings = generar_embeddings_textos(
+            list(chunks.iterar_textos()),
+            modelo=modelo,
+            hashes=hashes,
+            ruta_checkpoint=obtener_ruta_checkpoint_embeddings(ruta_cache),
+            progreso=progreso,
+        )
+
+    guardar_cache_embeddings(ruta_cache, chunks, embeddings, manifiesto, hashes)
     return chunks, embeddings
 
 
@@ -329,44 +979,453 @@ def calcular_scores_semanticos(
     return embeddings_chunks @ embedding_consulta
 
 
+def seleccionar_indices_mejores(scores: np.ndarray, limite: int) -> np.ndarray:
+    limite = min(limite, scores.shape[-1])
+    if limite <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+
+    candidatos = np.argpartition(-scores, limite - 1, axis=-1)[..., :limite]
+    orden = np.argsort(
+        -np.take_along_axis(scores, candidatos, axis=-1), axis=-1, kind="stable"
+    )
+    return np.take_along_axis(candidatos, orden, axis=-1)
+
+
+def preparar_indice_ivf(
+    ruta_cache: Path,
+    chunks: AlmacenChunks,
+    embeddings: np.ndarray,
+    minimo_chunks: int = MINIMO_CHUNKS_IVF,
+) -> IndiceIVF | None:
+    if len(chunks) < max(minimo_chunks, 1) or embeddings.size == 0:
+        return None
+
+    ruta = obtener_ruta_ivf_embeddings(ruta_cache)
+    clave = calcular_hash_raiz(chunks.calcular_hashes())
+    indice = cargar_indice_ivf(ruta, clave)
+    if indice is None:
+        indice = construir_indice_ivf(embeddings, clave=clave)
+        try:
+            indice.guardar(ruta)
+        except OSError:
+            pass
+
+    return indice
+
+
+def generar_embeddings_mezcla(
+    embeddings: np.ndarray,
+    filas: int,
+    ruido: float = RUIDO_BENCHMARK_IVF,
+    semilla: int = 0,
+) -> np.ndarray:
+    generador = np.random.default_rng(semilla)
+    primeros, segundos = generador.integers(len(embeddings), size=(2, filas))
+    pesos = generador.random((filas, 1), dtype=np.float32)
+    mezclas = pesos * embeddings[primeros] + (1 - pesos) * embeddings[segundos]
+    mezclas += generador.normal(
+        scale=ruido / np.sqrt(embeddings.shape[1]), size=mezclas.shape
+    ).astype(np.float32)
+    return normalizar_embeddings(mezclas).astype(np.float32)
+
+
+def medir_indice_ivf(
+    embeddings: np.ndarray,
+    consultas: np.ndarray,
+    limite: int = LIMITE_BENCHMARK_IVF,
+    nprobes: tuple[int, ...] = NPROBES_BENCHMARK_IVF,
+) -> tuple[IndiceIVF, float, float, list[tuple[int, float, float]]]:
+    inicio = time.perf_counter()
+    indice = construir_indice_ivf(embeddings)
+    tiempo_construccion = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    exactos = [
+        seleccionar_indices_mejores(embeddings @ consulta, limite)
+        for consulta in consultas
+    ]
+    velocidad_exacta = len(consultas) / (time.perf_counter() - inicio)
+    medidas: list[tuple[int, float, float]] = []
+
+    for nprobe in nprobes:
+        if nprobe > len(indice):
+            break
+
+        aproximados: list[np.ndarray] = []
+        inicio = time.perf_counter()
+        for consulta in consultas:
+            candidatos = np.sort(indice.obtener_candidatos(consulta, nprobe))
+            scores = embeddings[candidatos] @ consulta
+            aproximados.append(candidatos[seleccionar_indices_mejores(scores, limite)])
+        velocidad = len(consultas) / (time.perf_counter() - inicio)
+
+        aciertos = sum(
+            len(np.intersect1d(aproximado, exacto))
+            for aproximado, exacto in zip(aproximados, exactos)
+        )
+        medidas.append((nprobe, aciertos / max(sum(map(len, exactos)), 1), velocidad))
+
+    return indice, tiempo_construccion, velocidad_exacta, medidas
+
+
+class IndiceSemantico:
+    def __init__(
+        self,
+        pasajes: AlmacenPasajes,
+        modelo: str = MODELO_EMBEDDINGS,
+        tokens_por_chunk: int = TOKENS_POR_CHUNK,
+        solape_tokens: int = SOLAPE_TOKENS,
+        nprobe: int = NPROBE,
+        minimo_chunks_ivf: int = MINIMO_CHUNKS_IVF,
+    ) -> None:
+        self.pasajes = pasajes
+        self.modelo = modelo
+        self.tokens_por_chunk = tokens_por_chunk
+        self.solape_tokens = solape_tokens
+        self.nprobe = nprobe
+        self.minimo_chunks_ivf = minimo_chunks_ivf
+        self.cerrojo = threading.Lock()
+        self.datos: tuple[AlmacenChunks, np.ndarray, IndiceIVF | None] | None = None
+
+    def construir_datos(
+        self, regenerar: bool = False
+    ) -> tuple[AlmacenChunks, np.ndarray, IndiceIVF | None]:
+        chunks, embeddings = construir_indice_semantico(
+            self.pasajes,
+            modelo=self.modelo,
+            tokens_por_chunk=self.tokens_por_chunk,
+            solape_tokens=self.solape_tokens,
+            regenerar=regenerar,
+        )
+        ruta_cache = obtener_ruta_cache_embeddings(
+            self.modelo,
+            tokens_por_chunk=self.tokens_por_chunk,
+            solape_tokens=self.solape_tokens,
+            nombre_corpus=self.pasajes.nombre,
+        )
+        return (
+            chunks,
+            embeddings,
+            preparar_indice_ivf(
+                ruta_cache, chunks, embeddings, minimo_chunks=self.minimo_chunks_ivf
+            ),
+        )
+
+    def obtener_datos(self) -> tuple[AlmacenChunks, np.ndarray, IndiceIVF | None]:
+        datos = self.datos
+        if datos is not None:
+            return datos
+
+        with self.cerrojo:
+            if self.datos is None:
+                self.datos = self.construir_datos()
+            return self.datos
+
+    def cargar(self) -> tuple[AlmacenChunks, np.ndarray]:
+        chunks, embeddings, _ = self.obtener_datos()
+        return chunks, embeddings
+
+    def recargar(self, regenerar: bool = False) -> tuple[AlmacenChunks, np.ndarray]:
+        with self.cerrojo:
+            self.datos = self.construir_datos(regenerar=regenerar)
+            return self.datos[0], self.datos[1]
+
+    def buscar(self, embedding_consulta: np.ndarray, limite: int) -> list[Chunk]:
+        chunks, embeddings, ivf = self.obtener_datos()
+        if ivf is None:
+            scores = calcular_scores_semanticos(embedding_consulta, embeddings)
+            return [
+                Chunk(chunks, indice, float(scores[indice]))
+                for indice in seleccionar_indices_mejores(scores, limite).tolist()
+            ]
+
+        candidatos = np.sort(ivf.obtener_candidatos(embedding_consulta, self.nprobe))
+        scores = calcular_scores_semanticos(embedding_consulta, embeddings[candidatos])
+        return [
+            Chunk(chunks, int(candidatos[posicion]), float(scores[posicion]))
+            for posicion in seleccionar_indices_mejores(scores, limite).tolist()
+        ]
+
+    def buscar_lote(
+        self, embeddings_consultas: np.ndarray, limite: int
+    ) -> list[list[Chunk]]:
+        chunks, embeddings, ivf = self.obtener_datos()
+        if embeddings.size == 0 or embeddings_consultas.size == 0:
+            return [[] for _ in range(len(embeddings_consultas))]
+        if ivf is not None:
+            return [
+                self.buscar(embedding_consulta, limite)
+                for embedding_consulta in embeddings_consultas
+            ]
+
+        resultados: list[list[Chunk]] = []
+        for inicio in range(0, len(embeddings_consultas), LOTE_CONSULTAS):
+            scores = (
+                embeddings_consultas[inicio : inicio + LOTE_CONSULTAS] @ embeddings.T
+            )
+            mejores = seleccionar_indices_mejores(scores, limite)
+            scores_mejores = np.take_along_axis(scores, mejores, axis=-1)
+            resultados.extend(
+                [
+                    Chunk(chunks, indice, score)
+                    for indice, score in zip(indices_fila, scores_fila)
+                ]
+                for indices_fila, scores_fila in zip(
+                    mejores.tolist(), scores_mejores.tolist()
+                )
+            )
+
+        return resultados
+
+
+_indices_semanticos: dict[tuple[int, str, int, int], IndiceSemantico] = {}
+_cerrojo_indices_semanticos = threading.Lock()
+
+
+def obtener_indice_semantico(
+    pasajes: AlmacenPasajes,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+) -> IndiceSemantico:
+    clave = (id(pasajes), modelo, tokens_por_chunk, solape_tokens)
+
+    with _cerrojo_indices_semanticos:
+        indice = _indices_semanticos.get(clave)
+        if indice is None or indice.pasajes is not pasajes:
+            indice = IndiceSemantico(
+                pasajes,
+                modelo=modelo,
+                tokens_por_chunk=tokens_por_chunk,
+                solape_tokens=solape_tokens,
+            )
+            _indices_semanticos[clave] = indice
+
+    return indice
+
+
+def buscar_chunks_libro(
+    pasajes: AlmacenPasajes,
+    embedding_consulta: np.ndarray,
+    limite: int,
+    modelo: str,
+    tokens_por_chunk: int,
+    solape_tokens: int,
+    regenerar: bool,
+) -> list[tuple[float, str, str, int, int]]:
+    indice = obtener_indice_semantico(
+        pasajes,
+        modelo=modelo,
+        tokens_por_chunk=tokens_por_chunk,
+        solape_tokens=solape_tokens,
+    )
+    if regenerar:
+        indice.recargar(regenerar=True)
+
+    return [
+        (chunk.score, chunk.encabezado, chunk.texto, chunk.inicio, chunk.fin)
+        for chunk in indice.buscar(embedding_consulta, limite)
+    ]
+
+
+def buscar_lote_libro(
+    pasajes: AlmacenPasajes,
+    embeddings_consultas: np.ndarray,
+    limite: int,
+    modelo: str,
+    tokens_por_chunk: int,
+    solape_tokens: int,
+) -> list[list[tuple[float, str, str, int, int]]]:
+    indice = obtener_indice_semantico(
+        pasajes,
+        modelo=modelo,
+        tokens_por_chunk=tokens_por_chunk,
+        solape_tokens=solape_tokens,
+    )
+
+    return [
+        [
+            (chunk.score, chunk.encabezado, chunk.texto, chunk.inicio, chunk.fin)
+            for chunk in resultados
+        ]
+        for resultados in indice.buscar_lote(embeddings_consultas, limite)
+    ]
+
+
+def construir_chunks_libro(
+    libro: AlmacenPasajes, mejores: list[tuple[float, str, str, int, int]]
+) -> list[Chunk]:
+    chunks = construir_almacen_chunks(
+        (entrada[1:] for entrada in mejores),
+        titulo=libro.titulo,
+        nombre=libro.nombre,
+    )
+    return [Chunk(chunks, indice, entrada[0]) for indice, entrada in enumerate(mejores)]
+
+
+def buscar_pasajes_semanticos_en_libros(
+    biblioteca: BibliotecaLibros,
+    consulta: str,
+    limite: int = LIMITE_RESULTADOS,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+    regenerar: bool = False,
+) -> tuple[list[Chunk], str]:
+    embedding_consulta = obtener_embedding_consulta(consulta, modelo=modelo)
+    respuestas = biblioteca.repartir(
+        buscar_chunks_libro,
+        embedding_consulta,
+        limite,
+        modelo,
+        tokens_por_chunk,
+        solape_tokens,
+        regenerar,
+    )
+    candidatos = [
+        chunk
+        for libro, mejores in zip(biblioteca.libros, respuestas)
+        for chunk in construir_chunks_libro(libro, mejores)
+    ]
+
+    return heapq.nlargest(limite, candidatos, key=lambda chunk: chunk.score), modelo
+
+
 def buscar_pasajes_semanticos(
-    pasajes: list[dict[str, str]],
+    pasajes: AlmacenPasajes | BibliotecaLibros,
     consulta: str,
     limite: int = LIMITE_RESULTADOS,
     modelo: str = MODELO_EMBEDDINGS,
     tokens_por_chunk: int = TOKENS_POR_CHUNK,
     solape_tokens: int = SOLAPE_TOKENS,
     regenerar: bool = False,
-) -> tuple[list[dict[str, str | float | int]], str]:
+) -> tuple[list[Chunk], str]:
     if not consulta.strip():
         return [], modelo
 
-    chunks, embeddings = construir_indice_semantico(
+    if not isinstance(pasajes, AlmacenPasajes):
+        return buscar_pasajes_semanticos_en_libros(
+            pasajes,
+            consulta,
+            limite=limite,
+            modelo=modelo,
+            tokens_por_chunk=tokens_por_chunk,
+            solape_tokens=solape_tokens,
+            regenerar=regenerar,
+        )
+
+    indice = obtener_indice_semantico(
         pasajes,
         modelo=modelo,
         tokens_por_chunk=tokens_por_chunk,
         solape_tokens=solape_tokens,
-        regenerar=regenerar,
     )
+    if regenerar:
+        indice.recargar(regenerar=True)
+
     embedding_consulta = obtener_embedding_consulta(consulta, modelo=modelo)
-    scores = calcular_scores_semanticos(embedding_consulta, embeddings)
+    return indice.buscar(embedding_consulta, limite), modelo
 
-    if scores.size == 0:
-        return [], modelo
 
-    indices_ordenados = np.argsort(scores)[::-1][:limite]
-    resultados: list[dict[str, str | float | int]] = []
+def buscar_lote(
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    consultas: list[str],
+    limite: int = LIMITE_RESULTADOS,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+) -> tuple[list[list[Chunk]], str]:
+    validas = [
+        posicion for posicion, consulta in enumerate(consultas) if consulta.strip()
+    ]
+    resultados: list[list[Chunk]] = [[] for _ in consultas]
+    if not validas:
+        return resultados, modelo
 
-    for indice in indices_ordenados:
-        chunk = chunks[int(indice)]
-        resultados.append(
-            {
-                "encabezado": str(chunk["encabezado"]),
-                "texto": str(chunk["texto"]),
-                "score": float(scores[int(indice)]),
-                "inicio": int(chunk["inicio"]),
-                "fin": int(chunk["fin"]),
-            }
+    embeddings_consultas = obtener_embeddings_consultas(
+        [consultas[posicion] for posicion in validas], modelo=modelo
+    )
+
+    if isinstance(pasajes, AlmacenPasajes):
+        encontrados = obtener_indice_semantico(
+            pasajes,
+            modelo=modelo,
+            tokens_por_chunk=tokens_por_chunk,
+            solape_tokens=solape_tokens,
+        ).buscar_lote(embeddings_consultas, limite)
+    else:
+        respuestas = pasajes.repartir(
+            buscar_lote_libro,
+            embeddings_consultas,
+            limite,
+            modelo,
+            tokens_por_chunk,
+            solape_tokens,
         )
+        encontrados = [
+            heapq.nlargest(
+                limite,
+                (
+                    chunk
+                    for libro, mejores in zip(pasajes.libros, respuestas)
+                    for chunk in construir_chunks_libro(libro, mejores[posicion])
+                ),
+                key=lambda chunk: chunk.score,
+            )
+            for posicion in range(len(validas))
+        ]
 
+    for posicion, chunks in zip(validas, encontrados):
+        resultados[posicion] = chunks
     return resultados, modelo
+
+
+def parsear_argumentos(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convierte una cache de embeddings .npz al formato mapeable"
+    )
+    parser.add_argument(
+        "entrada",
+        type=Path,
+        nargs="?",
+        default=obtener_ruta_cache_embeddings(extension=EXTENSION_EMBEDDINGS_NPZ),
+        help="Cache .npz de embeddings",
+    )
+    parser.add_argument("--salida", type=Path, help="Ruta del .npy generado")
+    parser.add_argument(
+        "--tipo",
+        choices=("float32", "float16"),
+        default=TIPO_EMBEDDINGS.name,
+        help="Tipo de los embeddings guardados",
+    )
+    parser.add_argument(
+        "--modelo", default=MODELO_EMBEDDINGS, help="Modelo de los embeddings"
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=TOKENS_POR_CHUNK, help="Tokens por chunk"
+    )
+    parser.add_argument(
+        "--solape", type=int, default=SOLAPE_TOKENS, help="Tokens de solape"
+    )
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    argumentos = parsear_argumentos(sys.argv[1:])
+    ruta = convertir_cache_embeddings(
+        argumentos.entrada,
+        argumentos.salida,
+        tipo=np.dtype(argumentos.tipo),
+        modelo=argumentos.modelo,
+        tokens_por_chunk=argumentos.tokens,
+        solape_tokens=argumentos.solape,
+    )
+    print(
+        f"Embeddings guardados en {ruta} y {obtener_ruta_metadatos_embeddings(ruta)}: "
+        f"{ruta.stat().st_size} + "
+        f"{obtener_ruta_metadatos_embeddings(ruta).stat().st_size} bytes."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+from almacen_pasajes import AlmacenPasajes, Chunk, Pasaje, construir_almacen_chunks
+from biblioteca_libros import BibliotecaLibros
+from buscar_quijote import (
+    RANKING_TFIDF,
+    analizar_consulta,
+    buscar_pasajes_con_modo,
+    obtener_indice_clasico,
+    obtener_libros,
+    obtener_lista_lemmas_significativos,
+)
+from busqueda_semantica import (
+    LIMITE_RESULTADOS,
+    MODELO_EMBEDDINGS,
+    SOLAPE_TOKENS,
+    TOKENS_POR_CHUNK,
+    buscar_pasajes_semanticos,
+    normalizar_texto,
+)
+from rag_quijote import (
+    MAX_RESULTADOS_CLASICOS,
+    MAX_RESULTADOS_SEMANTICOS,
+    MODELO_RAG,
+    responder_con_rag,
+)
+
+
+CAPACIDAD_CACHE_RESULTADOS = int(os.getenv("FDI_PLN_P4_CAPACIDAD_CACHE", "256"))
+RUTA_CACHE_RESULTADOS = os.getenv("FDI_PLN_P4_CACHE_RESULTADOS", "")
+VERSION_CACHE_RESULTADOS = 1
+
+
+def obtener_ruta_cache_resultados() -> Path | None:
+    return Path(RUTA_CACHE_RESULTADOS) if RUTA_CACHE_RESULTADOS else None
+
+
+def normalizar_consulta_clasica(consulta: str) -> str:
+    analisis = analizar_consulta(consulta)
+    if analisis.tiene_operadores():
+        return repr(analisis.arbol)
+    return " ".join(sorted(obtener_lista_lemmas_significativos(analisis.texto)))
+
+
+def calcular_version_corpus(pasajes: AlmacenPasajes | BibliotecaLibros) -> str:
+    resumen = hashlib.sha256()
+
+    for libro in obtener_libros(pasajes):
+        resumen.update(libro.nombre.encode("utf-8"))
+        resumen.update(b"\0")
+        resumen.update(obtener_indice_clasico(libro).hashes_pasajes.tobytes())
+
+    return resumen.hexdigest()[:16]
+
+
+class CacheResultados:
+    def __init__(
+        self,
+        capacidad: int = CAPACIDAD_CACHE_RESULTADOS,
+        ruta: Path | None = None,
+    ) -> None:
+        self.capacidad = capacidad
+        self.ruta = ruta
+        self.entradas: OrderedDict[str, object] = OrderedDict()
+        self.versiones: dict[int, tuple[AlmacenPasajes | BibliotecaLibros, str]] = {}
+        self.aciertos = 0
+        self.fallos = 0
+
+        if ruta is not None:
+            self.cargar()
+
+    def __len__(self) -> int:
+        return len(self.entradas)
+
+    def obtener_version(self, pasajes: AlmacenPasajes | BibliotecaLibros) -> str:
+        registrada = self.versiones.get(id(pasajes))
+        if registrada is None or registrada[0] is not pasajes:
+            registrada = (pasajes, calcular_version_corpus(pasajes))
+            self.versiones[id(pasajes)] = registrada
+        return registrada[1]
+
+    def obtener(self, clave: tuple) -> object | None:
+        texto_clave = json.dumps(clave, ensure_ascii=False)
+        valor = self.entradas.get(texto_clave)
+        if valor is None:
+            self.fallos += 1
+            return None
+
+        self.entradas.move_to_end(texto_clave)
+        self.aciertos += 1
+        return valor
+
+    def guardar(self, clave: tuple, valor: object) -> None:
+        texto_clave = json.dumps(clave, ensure_ascii=False)
+        self.entradas[texto_clave] = valor
+        self.entradas.move_to_end(texto_clave)
+
+        while len(self.entradas) > self.capacidad:
+            self.entradas.popitem(last=False)
+
+    def describir(self) -> str:
+        return (
+            f"Cache: {self.aciertos} aciertos, {self.fallos} fallos, "
+            f"{len(self.entradas)}/{self.capacidad} entradas."
+        )
+
+    def cargar(self) -> None:
+        if self.ruta is None or not self.ruta.exists():
+            return
+
+        try:
+            datos = json.loads(self.ruta.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+
+        if datos.get("version") != VERSION_CACHE_RESULTADOS:
+            return
+
+        for texto_clave, valor in datos.get("entradas", [])[-self.capacidad :]:
+            self.entradas[texto_clave] = valor
+
+    def persistir(self) -> None:
+        if self.ruta is None:
+            return
+
+        temporal = self.ruta.with_suffix(self.ruta.suffix + ".tmp")
+        try:
+            temporal.write_text(
+                json.dumps(
+                    {
+                        "version": VERSION_CACHE_RESULTADOS,
+                        "entradas": list(self.entradas.items()),
+                    },
+                    ensure_ascii=False,
+                ),
+                encoding="utf-8",
+            )
+            temporal.replace(self.ruta)
+        except OSError:
+            pass
+
+
+def buscar_pasajes_con_cache(
+    cache: CacheResultados,
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    consulta: str,
+    limite: int | None = None,
+    ranking: str = RANKING_TFIDF,
+) -> tuple[list[Pasaje], str, int]:
+    libros = obtener_libros(pasajes)
+    clave = (
+        "clasica",
+        ranking,
+        normalizar_consulta_clasica(consulta),
+        limite,
+        cache.obtener_version(pasajes),
+    )
+    valor = cache.obtener(clave)
+
+    if valor is None:
+        resultados, modo, total = buscar_pasajes_con_modo(
+            pasajes, consulta, limite=limite, ranking=ranking
+        )
+        posiciones = {id(libro): posicion for posicion, libro in enumerate(libros)}
+        valor = {
+            "resultados": [
+                [posiciones[id(resultado.almacen)], resultado.indice, resultado.score]
+                for resultado in resultados
+            ],
+            "modo": modo,
+            "total": total,
+        }
+        cache.guardar(clave, valor)
+
+    return (
+        [
+            Pasaje(libros[posicion], indice, score)
+            for posicion, indice, score in valor["resultados"]
+        ],
+        valor["modo"],
+        valor["total"],
+    )
+
+
+def buscar_pasajes_semanticos_con_cache(
+    cache: CacheResultados,
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    consulta: str,
+    limite: int = LIMITE_RESULTADOS,
+    modelo: str = MODELO_EMBEDDINGS,
+    tokens_por_chunk: int = TOKENS_POR_CHUNK,
+    solape_tokens: int = SOLAPE_TOKENS,
+) -> tuple[list[Chunk], str]:
+    clave = (
+        "embeddings",
+        normalizar_texto(consulta),
+        modelo,
+        tokens_por_chunk,
+        solape_tokens,
+        limite,
+        cache.obtener_version(pasajes),
+    )
+    valor = cache.obtener(clave)
+
+    if valor is None:
+        resultados, modelo_usado = buscar_pasajes_semanticos(
+            pasajes,
+            consulta,
+            limite=limite,
+            modelo=modelo,
+            tokens_por_chunk=tokens_por_chunk,
+            solape_tokens=solape_tokens,
+        )
+        valor = {
+            "resultados": [
+                [
+                    resultado.score,
+                    resultado.titulo,
+                    resultado.almacen.nombre,
+                    resultado.encabezado,
+                    resultado.texto,
+                    resultado.inicio,
+                    resultado.fin,
+                ]
+                for resultado in resultados
+            ],
+            "modelo": modelo_usado,
+        }
+        cache.guardar(clave, valor)
+
+    return (
+        [
+            Chunk(
+                construir_almacen_chunks(
+                    [(encabezado, texto, inicio, fin)], titulo=titulo, nombre=nombre
+                ),
+                0,
+                score,
+            )
+            for score, titulo, nombre, encabezado, texto, inicio, fin in valor[
+                "resultados"
+            ]
+        ],
+        valor["modelo"],
+    )
+
+
+def responder_rag_con_cache(
+    cache: CacheResultados,
+    consulta: str,
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    modelo: str = MODELO_RAG,
+) -> dict[str, object]:
+    clave = (
+        "rag",
+        normalizar_texto(consulta),
+        modelo,
+        MODELO_EMBEDDINGS,
+        MAX_RESULTADOS_CLASICOS,
+        MAX_RESULTADOS_SEMANTICOS,
+        TOKENS_POR_CHUNK,
+        SOLAPE_TOKENS,
+        cache.obtener_version(pasajes),
+    )
+    valor = cache.obtener(clave)
+
+    if valor is None:
+        valor = responder_con_rag(consulta, pasajes, modelo=modelo)
+        cache.guardar(clave, valor)
+
+    return valor
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import re
+from bisect import bisect_right
+from typing import TYPE_CHECKING
+
+from almacen_pasajes import AlmacenPasajes, Chunk, Pasaje
+from buscar_quijote import (
+    analizar_consulta,
+    obtener_libros,
+    obtener_rangos_lemmas_coincidentes,
+)
+
+if TYPE_CHECKING:
+    from biblioteca_libros import BibliotecaLibros
+
+
+LARGO_EXTRACTO = 280
+MARGEN_PALABRA = 20
+ELIPSIS = "..."
+PATRON_PALABRA = re.compile(r"\S+")
+
+
+def seleccionar_ventana(
+    rangos: list[tuple[int, int]], largo_texto: int, largo: int = LARGO_EXTRACTO
+) -> tuple[int, int]:
+    if largo_texto <= largo:
+        return 0, largo_texto
+    if not rangos:
+        return 0, largo
+
+    mejor_inicio, mejor_fin, mejor_cuenta = 0, 0, 0
+    derecha = 0
+
+    for izquierda, (inicio, _) in enumerate(rangos):
+        derecha = max(derecha, izquierda)
+        while derecha + 1 < len(rangos) and rangos[derecha + 1][1] - inicio <= largo:
+            derecha += 1
+        if derecha - izquierda + 1 > mejor_cuenta:
+            mejor_inicio = inicio
+            mejor_fin = rangos[derecha][1]
+            mejor_cuenta = derecha - izquierda + 1
+
+    margen = max(largo - (mejor_fin - mejor_inicio), 0) // 2
+    inicio = min(max(mejor_inicio - margen, 0), largo_texto - largo)
+    return inicio, inicio + largo
+
+
+def ajustar_a_palabras(
+    texto: str, inicio: int, fin: int, margen: int = MARGEN_PALABRA
+) -> tuple[int, int]:
+    if inicio > 0 and not texto[inicio - 1].isspace():
+        limite = max(inicio - margen, 0)
+        espacio = texto.rfind(" ", limite, inicio)
+        if espacio >= 0:
+            inicio = espacio + 1
+        elif limite == 0:
+            inicio = 0
+    if fin < len(texto) and not texto[fin].isspace():
+        limite = min(fin + margen, len(texto))
+        espacio = texto.find(" ", fin, limite)
+        if espacio >= 0:
+            fin = espacio
+        elif limite == len(texto):
+            fin = len(texto)
+    return inicio, fin
+
+
+def construir_extracto(
+    texto: str, rangos: list[tuple[int, int]], largo: int = LARGO_EXTRACTO
+) -> tuple[str, list[tuple[int, int]]]:
+    rangos = sorted(rangos)
+    inicio, fin = ajustar_a_palabras(
+        texto, *seleccionar_ventana(rangos, len(texto), largo)
+    )
+    prefijo = ELIPSIS if inicio > 0 else ""
+    sufijo = ELIPSIS if fin < len(texto) else ""
+    desplazamiento = len(prefijo) - inicio
+
+    return f"{prefijo}{texto[inicio:fin]}{sufijo}", [
+        (inicio_rango + desplazamiento, fin_rango + desplazamiento)
+        for inicio_rango, fin_rango in rangos
+        if inicio <= inicio_rango and fin_rango <= fin
+    ]
+
+
+def obtener_rangos_chunk(
+    pasajes: AlmacenPasajes | BibliotecaLibros, resultado: Chunk, consulta: str
+) -> list[tuple[int, int]]:
+    libro = next(
+        (
+            libro
+            for libro in obtener_libros(pasajes)
+            if libro.nombre == resultado.almacen.nombre
+        ),
+        None,
+    )
+    if libro is None:
+        return []
+    try:
+        analizar_consulta(consulta)
+    except ValueError:
+        return []
+
+    palabras: list[str] = []
+    rangos: list[tuple[int, int]] = []
+    cursor = 0
+
+    for id_pasaje in range(resultado.inicio, resultado.fin + 1):
+        texto = libro.obtener_texto(id_pasaje)
+        limites = [(m.start(), m.end()) for m in PATRON_PALABRA.finditer(texto)]
+        inicios_palabras = [inicio for inicio, _ in limites]
+        posiciones = []
+        for inicio, fin in limites:
+            posiciones.append(cursor)
+            cursor += fin - inicio + 1
+            palabras.append(texto[inicio:fin])
+
+        for inicio, fin in obtener_rangos_lemmas_coincidentes(
+            libro, id_pasaje, consulta
+        ):
+            palabra = bisect_right(inicios_palabras, inicio) - 1
+            if palabra >= 0:
+                desplazado = posiciones[palabra] + inicio - inicios_palabras[palabra]
+                rangos.append((desplazado, desplazado + fin - inicio))
+
+    origen = " ".join(palabras).find(resultado.texto)
+    if origen < 0:
+        return []
+    final = origen + len(resultado.texto)
+    return [
+        (inicio - origen, fin - origen)
+        for inicio, fin in rangos
+        if origen <= inicio and fin <= final
+    ]
+
+
+def obtener_extracto_pasaje(
+    resultado: Pasaje, consulta: str, largo: int = LARGO_EXTRACTO
+) -> tuple[str, list[tuple[int, int]]]:
+    return construir_extracto(
+        resultado.texto,
+        obtener_rangos_lemmas_coincidentes(
+            resultado.almacen, resultado.indice, consulta
+        ),
+        largo,
+    )
+
+
+def obtener_extracto_chunk(
+    pasajes: AlmacenPasajes | BibliotecaLibros,
+    resultado: Chunk,
+    consulta: str,
+    largo: int = LARGO_EXTRACTO,
+) -> tuple[str, list[tuple[int, int]]]:
+    return construir_extracto(
+        resultado.texto, obtener_rangos_chunk(pasajes, resultado, consulta), largo
+    )
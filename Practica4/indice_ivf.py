@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+NPROBE = int(os.getenv("FDI_PLN_P4_NPROBE", "8"))
+ITERACIONES_KMEANS = 10
+MUESTRA_POR_LISTA = 32
+TAMANO_BLOQUE_ASIGNACION = 4096
+VERSION_INDICE_IVF = 1
+
+
+def calcular_numero_listas(filas: int) -> int:
+    return max(1, min(filas, int(round(4 * np.sqrt(filas)))))
+
+
+def normalizar_filas(matriz: np.ndarray) -> np.ndarray:
+    normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+    normas[normas == 0] = 1.0
+    return matriz / normas
+
+
+def asignar_listas(embeddings: np.ndarray, centroides: np.ndarray) -> np.ndarray:
+    asignacion = np.empty(len(embeddings), dtype=np.int32)
+
+    for inicio in range(0, len(embeddings), TAMANO_BLOQUE_ASIGNACION):
+        bloque = np.asarray(
+            embeddings[inicio : inicio + TAMANO_BLOQUE_ASIGNACION], dtype=np.float32
+        )
+        asignacion[inicio : inicio + len(bloque)] = np.argmax(
+            bloque @ centroides.T, axis=1
+        )
+
+    return asignacion
+
+
+def actualizar_centroides(
+    muestra: np.ndarray,
+    asignacion: np.ndarray,
+    listas: int,
+    generador: np.random.Generator,
+) -> np.ndarray:
+    sumas = np.zeros((listas, muestra.shape[1]), dtype=np.float32)
+    orden = np.argsort(asignacion, kind="stable")
+    ordenadas = asignacion[orden]
+    inicios = np.flatnonzero(np.r_[True, ordenadas[1:] != ordenadas[:-1]])
+    sumas[ordenadas[inicios]] = np.add.reduceat(muestra[orden], inicios, axis=0)
+
+    vacias = np.flatnonzero(~sumas.any(axis=1))
+    if vacias.size:
+        sumas[vacias] = muestra[
+            generador.choice(len(muestra), size=vacias.size, replace=False)
+        ]
+
+    return normalizar_filas(sumas)
+
+
+def entrenar_centroides(
+    embeddings: np.ndarray,
+    listas: int,
+    iteraciones: int = ITERACIONES_KMEANS,
+    semilla: int = 0,
+) -> np.ndarray:
+    generador = np.random.default_rng(semilla)
+    tamano_muestra = min(len(embeddings), listas * MUESTRA_POR_LISTA)
+    muestra = np.asarray(
+        embeddings[
+            np.sort(generador.choice(len(embeddings), tamano_muestra, replace=False))
+        ],
+        dtype=np.float32,
+    )
+    centroides = muestra[generador.choice(len(muestra), listas, replace=False)]
+
+    for _ in range(iteraciones):
+        centroides = actualizar_centroides(
+            muestra, asignar_listas(muestra, centroides), listas, generador
+        )
+
+    return centroides
+
+
+class IndiceIVF:
+    def __init__(
+        self,
+        centroides: np.ndarray,
+        indptr: np.ndarray,
+        filas: np.ndarray,
+        clave: str = "",
+    ) -> None:
+        self.centroides = centroides
+        self.indptr = indptr
+        self.filas = filas
+        self.clave = clave
+
+    def __len__(self) -> int:
+        return len(self.centroides)
+
+    def obtener_candidatos(
+        self, embedding_consulta: np.ndarray, nprobe: int = NPROBE
+    ) -> np.ndarray:
+        nprobe = max(1, min(nprobe, len(self)))
+        listas = np.argpartition(-(self.centroides @ embedding_consulta), nprobe - 1)[
+            :nprobe
+        ]
+
+        return np.concatenate(
+            [
+                self.filas[self.indptr[lista] : self.indptr[lista + 1]]
+                for lista in listas.tolist()
+            ]
+        )
+
+    def guardar(self, ruta: Path) -> None:
+        temporal = ruta.with_name(ruta.name + ".tmp")
+        with temporal.open("wb") as archivo:
+            np.savez(
+                archivo,
+                cabecera=np.asarray(
+                    json.dumps({"version": VERSION_INDICE_IVF, "clave": self.clave})
+                ),
+                centroides=self.centroides,
+                indptr=self.indptr,
+                filas=self.filas,
+            )
+        temporal.replace(ruta)
+
+
+def construir_indice_ivf(
+    embeddings: np.ndarray,
+    listas: int | None = None,
+    iteraciones: int = ITERACIONES_KMEANS,
+    clave: str = "",
+) -> IndiceIVF:
+    listas = listas or calcular_numero_listas(len(embeddings))
+    centroides = entrenar_centroides(embeddings, listas, iteraciones)
+    asignacion = asignar_listas(embeddings, centroides)
+    indptr = np.zeros(listas + 1, dtype=np.int64)
+    np.cumsum(np.bincount(asignacion, minlength=listas), out=indptr[1:])
+
+    return IndiceIVF(
+        centroides,
+        indptr,
+        np.argsort(asignacion, kind="stable").astype(np.int32),
+        clave=clave,
+    )
+
+
+def cargar_indice_ivf(ruta: Path, clave: str) -> IndiceIVF | None:
+    if not ruta.exists():
+        return None
+
+    try:
+        with np.load(ruta, allow_pickle=False) as datos:
+            cabecera = json.loads(str(datos["cabecera"]))
+            if (
+                cabecera.get("version") != VERSION_INDICE_IVF
+                or cabecera.get("clave") != clave
+            ):
+                return None
+            return IndiceIVF(
+                datos["centroides"], datos["indptr"], datos["filas"], clave=clave
+            )
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import re
+from collections.abc import Callable
+from functools import lru_cache
+
+try:
+    from spacy.attrs import ORTH
+    from spacy.lang.es import Spanish
+    from spacy.util import (
+        compile_infix_regex,
+        compile_prefix_regex,
+        compile_suffix_regex,
+        load_language_data,
+        registry,
+    )
+except ImportError:  # pragma: no cover - depende del entorno
+    Spanish = None
+
+
+PATRON_TROZOS = re.compile(r"\S+")
+
+
+class LematizadorRapido:
+    def __init__(
+        self,
+        tabla_lemas: dict[str, str],
+        stopwords: frozenset[str],
+        excepciones: dict[str, tuple[str, ...]],
+        patron_prefijos: re.Pattern[str],
+        patron_sufijos: re.Pattern[str],
+        patron_infijos: re.Pattern[str],
+        coincide_url: Callable[[str], object] | None = None,
+    ) -> None:
+        self.tabla_lemas = tabla_lemas
+        self.stopwords = stopwords
+        self.excepciones = excepciones
+        self.patron_prefijos = patron_prefijos
+        self.patron_sufijos = patron_sufijos
+        self.patron_infijos = patron_infijos
+        self.coincide_url = coincide_url
+
+    def medir_prefijo(self, cadena: str) -> int:
+        coincidencia = self.patron_prefijos.search(cadena)
+        return coincidencia.end() - coincidencia.start() if coincidencia else 0
+
+    def medir_sufijo(self, cadena: str) -> int:
+        coincidencia = self.patron_sufijos.search(cadena)
+        return coincidencia.end() - coincidencia.start() if coincidencia else 0
+
+    def separar_afijos(self, cadena: str) -> tuple[list[str], str, list[str]]:
+        prefijos: list[str] = []
+        sufijos: list[str] = []
+        ultimo_tamano = 0
+
+        while cadena and len(cadena) != ultimo_tamano:
+            if cadena in self.excepciones:
+                break
+
+            ultimo_tamano = len(cadena)
+            largo_prefijo = self.medir_prefijo(cadena)
+            if largo_prefijo:
+                prefijo = cadena[:largo_prefijo]
+                sin_prefijo = cadena[largo_prefijo:]
+                if sin_prefijo in self.excepciones:
+                    prefijos.append(prefijo)
+                    cadena = sin_prefijo
+                    break
+
+            largo_sufijo = self.medir_sufijo(cadena[largo_prefijo:])
+            if largo_sufijo:
+                sufijo = cadena[-largo_sufijo:]
+                sin_sufijo = cadena[:-largo_sufijo]
+                if sin_sufijo in self.excepciones:
+                    sufijos.append(sufijo)
+                    cadena = sin_sufijo
+                    break
+
+            if (
+                largo_prefijo
+                and largo_sufijo
+                and (largo_prefijo + largo_sufijo <= len(cadena))
+            ):
+                cadena = cadena[largo_prefijo:-largo_sufijo]
+                prefijos.append(prefijo)
+                sufijos.append(sufijo)
+            elif largo_prefijo:
+                cadena = sin_prefijo
+                prefijos.append(prefijo)
+            elif largo_sufijo:
+                cadena = sin_sufijo
+                sufijos.append(sufijo)
+
+        return prefijos, cadena, sufijos[::-1]
+
+    def dividir_nucleo(self, cadena: str) -> list[str]:
+        if cadena in self.excepciones:
+            return list(self.excepciones[cadena])
+
+        if self.coincide_url is not None and self.coincide_url(cadena):
+            return [cadena]
+
+        partes: list[str] = []
+        inicio = 0
+
+        for coincidencia in self.patron_infijos.finditer(cadena):
+            if coincidencia.start() == 0:
+                continue
+            if coincidencia.start() != inicio:
+                partes.append(cadena[inicio : coincidencia.start()])
+            if coincidencia.start() != coincidencia.end():
+                partes.append(coincidencia.group(0))
+            inicio = coincidencia.end()
+
+        if cadena[inicio:]:
+            partes.append(cadena[inicio:])
+
+        return partes
+
+    def tokenizar(self, texto: str) -> list[tuple[str, int]]:
+        tokens: list[tuple[str, int]] = []
+
+        for trozo in PATRON_TROZOS.finditer(texto):
+            cadena = trozo.group(0)
+            if cadena.isalpha() and cadena not in self.excepciones:
+                tokens.append((cadena, trozo.start()))
+                continue
+
+            prefijos, nucleo, sufijos = self.separar_afijos(cadena)
+            partes = prefijos + (self.dividir_nucleo(nucleo) if nucleo else [])
+            posicion = trozo.start()
+
+            for parte in partes + sufijos:
+                tokens.append((parte, posicion))
+                posicion += len(parte)
+
+        return tokens
+
+    def obtener_lemma(self, forma: str) -> str:
+        return self.tabla_lemas.get(forma, forma).strip().lower() or forma.lower()
+
+    def obtener_tokens_significativos(
+        self, texto: str
+    ) -> list[tuple[str, int, int, int]]:
+        tokens: list[tuple[str, int, int, int]] = []
+        posicion = 0
+
+        for forma, inicio in self.tokenizar(texto):
+            if not forma.isalpha():
+                continue
+            if forma.lower() not in self.stopwords:
+                tokens.append(
+                    (self.obtener_lemma(forma), inicio, inicio + len(forma), posicion)
+                )
+            posicion += 1
+
+        return tokens
+
+
+@lru_cache(maxsize=1)
+def obtener_lematizador_rapido() -> LematizadorRapido:
+    if Spanish is None:
+        raise RuntimeError(
+            "spaCy no esta disponible. Ejecuta `uv sync` en Practica4 para instalar las dependencias."
+        )
+
+    tablas = registry.lookups.get("es")
+    excepciones = {
+        texto: tuple(pieza[ORTH] for pieza in piezas)
+        for texto, piezas in Spanish.Defaults.tokenizer_exceptions.items()
+    }
+    return LematizadorRapido(
+        tabla_lemas=load_language_data(tablas["lemma_lookup"]),
+        stopwords=frozenset(Spanish.Defaults.stop_words),
+        excepciones=excepciones,
+        patron_prefijos=compile_prefix_regex(Spanish.Defaults.prefixes),
+        patron_sufijos=compile_suffix_regex(Spanish.Defaults.suffixes),
+        patron_infijos=compile_infix_regex(Spanish.Defaults.infixes),
+        coincide_url=Spanish.Defaults.url_match,
+    )
@@ -2,41 +2,72 @@ from __future__ import annotations
 
 import argparse
 import sys
+from pathlib import Path
 
 from rich.text import Text
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal, VerticalScroll
 from textual.widgets import Button, Footer, Header, Input, Select, Static
 
+from almacen_pasajes import AlmacenPasajes, Chunk, Pasaje
+from artefacto_quijote import cargar_indice_quijote
+from biblioteca_libros import BibliotecaLibros, cargar_biblioteca
 from buscar_quijote import (
     LIMITE_RESULTADOS,
+    RANKING_BM25,
+    RANKING_TFIDF,
     RUTA_QUIJOTE,
-    buscar_pasajes_con_modo,
-    extraer_pasajes,
-    obtener_rangos_lemmas_coincidentes,
+    obtener_expansiones_consulta,
 )
-from busqueda_semantica import MODELO_EMBEDDINGS, buscar_pasajes_semanticos
-from rag_quijote import MODELO_RAG, responder_con_rag
+from busqueda_semantica import MODELO_EMBEDDINGS, obtener_cache_embeddings_consulta
+from cache_resultados import (
+    CacheResultados,
+    buscar_pasajes_con_cache,
+    buscar_pasajes_semanticos_con_cache,
+    obtener_ruta_cache_resultados,
+    responder_rag_con_cache,
+)
+from extractos_pasajes import obtener_extracto_chunk, obtener_extracto_pasaje
+from rag_quijote import MODELO_RAG
 
 
 ESTILO_RESALTADO = "bold #201a16 on #f0bf5a"
+LIMITE_RESULTADOS_PANTALLA = 20
 MODO_CLASICO = "clasica"
+MODO_BM25 = "bm25"
 MODO_EMBEDDINGS = "embeddings"
 MODO_RAG = "rag"
 OPCIONES_MODO = [
     ("1. Busqueda clasica", MODO_CLASICO),
-    ("2. Busqueda por embeddings", MODO_EMBEDDINGS),
-    ("3. RAG", MODO_RAG),
+    ("2. Busqueda clasica BM25", MODO_BM25),
+    ("3. Busqueda por embeddings", MODO_EMBEDDINGS),
+    ("4. RAG", MODO_RAG),
 ]
 
 
+def formatear_encabezado(resultado: Pasaje) -> str:
+    if resultado.titulo:
+        return f"{resultado.titulo} - {resultado.encabezado}"
+    return resultado.encabezado
+
+
+def resaltar_extracto(extracto: str, rangos: list[tuple[int, int]]) -> Text:
+    texto = Text(extracto)
+    for inicio, fin in rangos:
+        texto.stylize(ESTILO_RESALTADO, inicio, fin)
+    return texto
+
+
 def construir_resultados_enriquecidos(
-    consulta: str, resultados: list[dict[str, str]], modo_busqueda: str
+    consulta: str,
+    resultados: list[Pasaje],
+    modo_busqueda: str,
+    total: int,
 ) -> Text:
     if not resultados:
         return Text(f'No se han encontrado pasajes con "{consulta}".')
 
-    texto = Text(f'Se han encontrado {len(resultados)} pasajes con "{consulta}".\n\n')
+    texto = Text(f'Se han encontrado {total} pasajes con "{consulta}".\n\n')
 
     if modo_busqueda == "or":
         texto.append("No hubo una coincidencia completa por lemas.\n")
@@ -44,21 +75,18 @@ def construir_resultados_enriquecidos(
             "Se muestran coincidencias parciales con alguno de los lemas buscados.\n\n"
         )
 
-    for indice, resultado in enumerate(resultados[:LIMITE_RESULTADOS], start=1):
-        texto.append(f"{indice}. {resultado['encabezado']}\n")
-
-        pasaje = Text(resultado["texto"])
-        for inicio, fin in obtener_rangos_lemmas_coincidentes(
-            resultado["texto"], consulta
-        ):
-            pasaje.stylize(ESTILO_RESALTADO, inicio, fin)
-
-        texto.append_text(pasaje)
+    for indice, resultado in enumerate(
+        resultados[:LIMITE_RESULTADOS_PANTALLA], start=1
+    ):
+        texto.append(f"{indice}. {formatear_encabezado(resultado)}\n")
+        texto.append_text(
+            resaltar_extracto(*obtener_extracto_pasaje(resultado, consulta))
+        )
         texto.append("\n\n")
 
-    if len(resultados) > LIMITE_RESULTADOS:
+    if total > LIMITE_RESULTADOS_PANTALLA:
         texto.append(
-            f"Se muestran solo los {LIMITE_RESULTADOS} primeros resultados de {len(resultados)}."
+            f"Se muestran solo los {LIMITE_RESULTADOS_PANTALLA} primeros resultados de {total}."
         )
 
     return texto
@@ -66,8 +94,9 @@ def construir_resultados_enriquecidos(
 
 def construir_resultados_semanticos_enriquecidos(
     consulta: str,
-    resultados: list[dict[str, str | float | int]],
+    resultados: list[Chunk],
     modelo: str,
+    pasajes: AlmacenPasajes | BibliotecaLibros,
 ) -> Text:
     if not resultados:
         return Text(
@@ -79,19 +108,21 @@ def construir_resultados_semanticos_enriquecidos(
     )
     texto.append(f"Modelo de embeddings: {modelo}.\n\n")
 
-    for indice, resultado in enumerate(resultados[:LIMITE_RESULTADOS], start=1):
+    for indice, resultado in enumerate(
+        resultados[:LIMITE_RESULTADOS_PANTALLA], start=1
+    ):
         texto.append(
-            f"{indice}. {resultado['encabezado']} (score: {resultado['score']:.4f})\n"
+            f"{indice}. {formatear_encabezado(resultado)} (score: {resultado.score:.4f})\n"
         )
-        texto.append(
-            f"Chunk original: pasajes {resultado['inicio']} a {resultado['fin']}\n"
+        texto.append(f"Chunk original: pasajes {resultado.inicio} a {resultado.fin}\n")
+        texto.append_text(
+            resaltar_extracto(*obtener_extracto_chunk(pasajes, resultado, consulta))
         )
-        texto.append(str(resultado["texto"]))
         texto.append("\n\n")
 
-    if len(resultados) > LIMITE_RESULTADOS:
+    if len(resultados) > LIMITE_RESULTADOS_PANTALLA:
         texto.append(
-            f"Se muestran solo los {LIMITE_RESULTADOS} primeros resultados de {len(resultados)}."
+            f"Se muestran solo los {LIMITE_RESULTADOS_PANTALLA} primeros resultados de {len(resultados)}."
         )
 
     return texto
@@ -121,10 +152,16 @@ def parsear_argumentos(argv: list[str] | None = None) -> argparse.Namespace:
     parser.add_argument("consulta", nargs="*", help="Texto a buscar")
     parser.add_argument(
         "--modo",
-        choices=[MODO_CLASICO, MODO_EMBEDDINGS, MODO_RAG],
+        choices=[MODO_CLASICO, MODO_BM25, MODO_EMBEDDINGS, MODO_RAG],
         default=MODO_CLASICO,
         help="Modo de busqueda inicial",
     )
+    parser.add_argument(
+        "--libros",
+        type=Path,
+        default=None,
+        help="Directorio con libros HTML de Gutenberg a indexar como fragmentos",
+    )
     return parser.parse_args(argv)
 
 
@@ -183,17 +220,22 @@ class BuscadorQuijoteApp(App[None]):
     BINDINGS = [("ctrl+q", "quit", "Salir"), ("ctrl+c", "quit", "Salir")]
 
     def __init__(
-        self, consulta_inicial: str = "", modo_inicial: str = MODO_CLASICO
+        self,
+        consulta_inicial: str = "",
+        modo_inicial: str = MODO_CLASICO,
+        ruta_libros: Path | None = None,
     ) -> None:
         super().__init__()
         self.consulta_inicial = consulta_inicial
         self.modo_inicial = modo_inicial
-        self.pasajes: list[dict[str, str]] = []
+        self.ruta_libros = ruta_libros
+        self.pasajes: AlmacenPasajes | BibliotecaLibros | None = None
+        self.cache = CacheResultados(ruta=obtener_ruta_cache_resultados())
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=False)
         yield Static(
-            "Elige un modo: clasico por lemas, semantico por embeddings o RAG. Luego escribe una consulta y busca pasajes del Quijote.",
+            "Elige un modo: clasico por lemas (TF-IDF o BM25), semantico por embeddings o RAG. Luego escribe una consulta y busca pasajes del Quijote.",
             id="intro",
         )
         with Horizontal(id="busqueda"):
@@ -218,7 +260,12 @@ class BuscadorQuijoteApp(App[None]):
         consulta.value = self.consulta_inicial
         consulta.focus()
 
-        if not RUTA_QUIJOTE.exists():
+        if self.ruta_libros is not None:
+            self.cargar_libros(self.ruta_libros)
+            return
+
+        indice = cargar_indice_quijote(guardar=True)
+        if indice is None:
             mensaje = f"No encuentro el archivo: {RUTA_QUIJOTE}"
             self.mostrar_resultados(mensaje)
             self.actualizar_estado(mensaje)
@@ -226,14 +273,38 @@ class BuscadorQuijoteApp(App[None]):
             consulta.disabled = True
             return
 
-        self.pasajes = extraer_pasajes(RUTA_QUIJOTE)
+        self.pasajes = indice.pasajes
+        self.actualizar_estado(
+            f"Archivo cargado: {RUTA_QUIJOTE.name}. Pasajes disponibles: {len(self.pasajes)}. Modos disponibles: clasica (TF-IDF o BM25), embeddings y RAG."
+        )
+
+        if self.consulta_inicial:
+            self.realizar_busqueda()
+
+    def cargar_libros(self, ruta_libros: Path) -> None:
+        biblioteca = cargar_biblioteca(ruta_libros)
+        if biblioteca is None:
+            mensaje = f"No encuentro libros HTML en: {ruta_libros}"
+            self.mostrar_resultados(mensaje)
+            self.actualizar_estado(mensaje)
+            self.query_one("#buscar", Button).disabled = True
+            self.query_one("#consulta", Input).disabled = True
+            return
+
+        self.pasajes = biblioteca
         self.actualizar_estado(
-            f"Archivo cargado: {RUTA_QUIJOTE.name}. Pasajes disponibles: {len(self.pasajes)}. Modos disponibles: clasica, embeddings y RAG."
+            f"Libros cargados: {', '.join(biblioteca.titulos)}. Pasajes disponibles: {len(biblioteca)}. Procesos de busqueda: {biblioteca.procesos}."
         )
 
         if self.consulta_inicial:
             self.realizar_busqueda()
 
+    def on_unmount(self) -> None:
+        self.cache.persistir()
+        obtener_cache_embeddings_consulta().persistir()
+        if isinstance(self.pasajes, BibliotecaLibros):
+            self.pasajes.cerrar()
+
     def on_input_submitted(self, event: Input.Submitted) -> None:
         if event.input.id == "consulta":
             self.realizar_busqueda()
@@ -245,6 +316,12 @@ class BuscadorQuijoteApp(App[None]):
     def actualizar_estado(self, mensaje: str) -> None:
         self.query_one("#estado", Static).update(Text(mensaje))
 
+    def actualizar_estado_con_cache(self, mensaje: str) -> None:
+        self.actualizar_estado(
+            f"{mensaje} {self.cache.describir()} "
+            f"{obtener_cache_embeddings_consulta().describir()}"
+        )
+
     def mostrar_resultados(self, renderizable: str | Text) -> None:
         if isinstance(renderizable, Text):
             self.query_one("#resultados", Static).update(renderizable)
@@ -268,10 +345,11 @@ class BuscadorQuijoteApp(App[None]):
                 f'Consulta actual: "{consulta}". Generando o cargando embeddings con {MODELO_EMBEDDINGS}...'
             )
             try:
-                resultados_semanticos, modelo = buscar_pasajes_semanticos(
+                resultados_semanticos, modelo = buscar_pasajes_semanticos_con_cache(
+                    self.cache,
                     self.pasajes,
                     consulta,
-                    limite=LIMITE_RESULTADOS,
+                    limite=LIMITE_RESULTADOS_PANTALLA,
                 )
             except Exception as error:
                 mensaje_error = (
@@ -282,12 +360,12 @@ class BuscadorQuijoteApp(App[None]):
                 self.mostrar_resultados(mensaje_error)
                 return
 
-            self.actualizar_estado(
+            self.actualizar_estado_con_cache(
                 f'Consulta actual: "{consulta}". Resultados semanticos: {len(resultados_semanticos)}. Modelo: {modelo}.'
             )
             self.mostrar_resultados(
                 construir_resultados_semanticos_enriquecidos(
-                    consulta, resultados_semanticos, modelo
+                    consulta, resultados_semanticos, modelo, self.pasajes
                 )
             )
             return
@@ -297,7 +375,9 @@ class BuscadorQuijoteApp(App[None]):
                 f'Consulta actual: "{consulta}". Recuperando contexto y generando respuesta con {MODELO_RAG}...'
             )
             try:
-                resultado_rag = responder_con_rag(consulta, self.pasajes)
+                resultado_rag = responder_rag_con_cache(
+                    self.cache, consulta, self.pasajes
+                )
             except Exception as error:
                 mensaje_error = (
                     f"No se ha podido ejecutar el modo RAG. Detalle: {error}"
@@ -307,7 +387,7 @@ class BuscadorQuijoteApp(App[None]):
                 return
 
             contexto = list(resultado_rag["contexto"])
-            self.actualizar_estado(
+            self.actualizar_estado_con_cache(
                 f'Consulta actual: "{consulta}". RAG completado con {len(contexto)} pasajes de contexto. Modelo: {resultado_rag["modelo"]}.'
             )
             self.mostrar_resultados(
@@ -315,17 +395,40 @@ class BuscadorQuijoteApp(App[None]):
             )
             return
 
-        resultados, modo_busqueda = buscar_pasajes_con_modo(self.pasajes, consulta)
-        mensaje_estado = f'Consulta actual: "{consulta}". Coincidencias encontradas: {len(resultados)}.'
+        ranking = RANKING_BM25 if modo == MODO_BM25 else RANKING_TFIDF
+        try:
+            resultados, modo_busqueda, total = buscar_pasajes_con_cache(
+                self.cache,
+                self.pasajes,
+                consulta,
+                limite=LIMITE_RESULTADOS_PANTALLA,
+                ranking=ranking,
+            )
+        except ValueError as error:
+            mensaje_error = f"Consulta no valida. Detalle: {error}"
+            self.actualizar_estado(mensaje_error)
+            self.mostrar_resultados(mensaje_error)
+            return
+
+        mensaje_estado = f'Consulta actual: "{consulta}". Coincidencias encontradas: {total}. Ranking: {ranking}.'
+        expansiones = obtener_expansiones_consulta(self.pasajes, consulta)
+        if expansiones:
+            mensaje_estado += " Expansiones: " + "; ".join(
+                f"{lemma} -> {', '.join(cercanos)}"
+                for lemma, cercanos in expansiones.items()
+            )
+            mensaje_estado += "."
 
         if modo_busqueda == "or" and resultados:
             mensaje_estado += (
                 " Sin coincidencia completa; mostrando coincidencias parciales."
             )
 
-        self.actualizar_estado(mensaje_estado)
+        self.actualizar_estado_con_cache(mensaje_estado)
         self.mostrar_resultados(
-            construir_resultados_enriquecidos(consulta, resultados, modo_busqueda)
+            construir_resultados_enriquecidos(
+                consulta, resultados, modo_busqueda, total
+            )
         )
 
 
@@ -335,6 +438,7 @@ def main() -> None:
     BuscadorQuijoteApp(
         consulta_inicial=consulta_inicial,
         modo_inicial=argumentos.modo,
+        ruta_libros=argumentos.libros,
     ).run()
 
 
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from itertools import accumulate
+
+import numpy as np
+
+
+TAMANO_BLOQUE_POSTINGS = 64
+FACTOR_GALOPE = 64
+LIMITE_DECODIFICACION_LISTA = 128
+
+
+def codificar_varint(valores: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    valores = valores.astype(np.uint64)
+    largos = np.ones(len(valores), dtype=np.int64)
+    restantes = valores >> np.uint64(7)
+
+    while restantes.any():
+        largos += restantes > 0
+        restantes >>= np.uint64(7)
+
+    inicios = np.cumsum(largos) - largos
+    datos = np.empty(int(largos.sum()), dtype=np.uint8)
+    restantes = valores.copy()
+
+    for byte in range(int(largos.max(initial=0))):
+        activos = np.flatnonzero(largos > byte)
+        continua = (largos[activos] > byte + 1).astype(np.uint64) << np.uint64(7)
+        datos[inicios[activos] + byte] = (
+            restantes[activos] & np.uint64(0x7F)
+        ) | continua
+        restantes[activos] >>= np.uint64(7)
+
+    return datos, inicios
+
+
+def decodificar_varint(datos: np.ndarray) -> np.ndarray:
+    continuan = np.flatnonzero(datos >= 0x80)
+    if not continuan.size:
+        return datos.astype(np.int64)
+
+    partes = (datos & 0x7F).astype(np.int64)
+    if continuan.size * FACTOR_GALOPE < len(datos):
+        for posicion in reversed(continuan.tolist()):
+            partes[posicion] |= partes[posicion + 1] << 7
+        inicios = np.ones(len(datos), dtype=bool)
+        inicios[continuan + 1] = False
+        return partes[inicios]
+
+    finales = np.flatnonzero(datos < 0x80)
+    inicios = np.empty_like(finales)
+    inicios[0] = 0
+    inicios[1:] = finales[:-1] + 1
+    desplazamientos = np.arange(len(datos)) - np.repeat(inicios, finales - inicios + 1)
+    return np.add.reduceat(partes << (7 * desplazamientos), inicios)
+
+
+def decodificar_varint_lista(datos: bytes | memoryview) -> list[int]:
+    valores: list[int] = []
+    valor = 0
+    desplazamiento = 0
+
+    for byte in datos:
+        valor |= (byte & 0x7F) << desplazamiento
+        if byte < 0x80:
+            valores.append(valor)
+            valor = 0
+            desplazamiento = 0
+        else:
+            desplazamiento += 7
+
+    return valores
+
+
+class PostingsComprimidos:
+    def __init__(
+        self,
+        datos: np.ndarray,
+        bytes_indptr: np.ndarray,
+        longitudes: np.ndarray,
+        saltos_valores: np.ndarray,
+        saltos_bytes: np.ndarray,
+        dtype: np.dtype,
+    ) -> None:
+        self.datos = datos
+        self.bytes_indptr = bytes_indptr
+        self.longitudes = longitudes
+        self.saltos_valores = saltos_valores
+        self.saltos_bytes = saltos_bytes
+        self.dtype = np.dtype(dtype)
+        self.memoria_datos = memoryview(datos).cast("B")
+        self.saltos_indptr = calcular_saltos_indptr(longitudes)
+
+    def __len__(self) -> int:
+        return len(self.longitudes)
+
+    def calcular_memoria(self) -> int:
+        return sum(
+            array.nbytes
+            for array in (
+                self.datos,
+                self.bytes_indptr,
+                self.longitudes,
+                self.saltos_valores,
+                self.saltos_bytes,
+                self.saltos_indptr,
+            )
+        )
+
+    def obtener_fila(self, fila: int) -> np.ndarray:
+        inicio, fin = self.bytes_indptr[fila : fila + 2].tolist()
+        if self.longitudes[fila] <= LIMITE_DECODIFICACION_LISTA:
+            deltas = decodificar_varint_lista(self.memoria_datos[inicio:fin])
+            return np.fromiter(accumulate(deltas), dtype=self.dtype, count=len(deltas))
+
+        return np.cumsum(decodificar_varint(self.datos[inicio:fin]), dtype=self.dtype)
+
+    def obtener_bloque(self, fila: int, bloque: int) -> list[int]:
+        primer_salto, ultimo_salto = self.saltos_indptr[fila : fila + 2]
+        if bloque:
+            inicio = self.saltos_bytes[primer_salto + bloque - 1]
+            base = int(self.saltos_valores[primer_salto + bloque - 1])
+        else:
+            inicio = self.bytes_indptr[fila]
+            base = 0
+        if primer_salto + bloque < ultimo_salto:
+            fin = self.saltos_bytes[primer_salto + bloque]
+        else:
+            fin = self.bytes_indptr[fila + 1]
+
+        valores = decodificar_varint_lista(self.memoria_datos[inicio:fin])
+        for indice, delta in enumerate(valores):
+            base += delta
+            valores[indice] = base
+        return valores
+
+    def intersectar(self, candidatos: np.ndarray, fila: int) -> np.ndarray:
+        if len(candidatos) * FACTOR_GALOPE < self.longitudes[fila]:
+            return np.asarray(
+                self.intersectar_galopante(candidatos.tolist(), fila), dtype=self.dtype
+            )
+        return np.intersect1d(candidatos, self.obtener_fila(fila), assume_unique=True)
+
+    def intersectar_galopante(self, candidatos: list[int], fila: int) -> list[int]:
+        primer_salto, ultimo_salto = self.saltos_indptr[fila : fila + 2].tolist()
+        saltos = self.saltos_valores[primer_salto:ultimo_salto].tolist()
+        resultado: list[int] = []
+        actual = 0
+        bloque_decodificado = -1
+        valores: list[int] = []
+
+        for candidato in candidatos:
+            paso = 1
+            while (
+                actual + paso <= len(saltos) and saltos[actual + paso - 1] < candidato
+            ):
+                actual += paso
+                paso *= 2
+            actual = bisect_left(
+                saltos, candidato, actual, min(actual + paso - 1, len(saltos))
+            )
+
+            if actual != bloque_decodificado:
+                valores = self.obtener_bloque(fila, actual)
+                bloque_decodificado = actual
+
+            posicion = bisect_left(valores, candidato)
+            if posicion < len(valores) and valores[posicion] == candidato:
+                resultado.append(candidato)
+
+        return resultado
+
+
+def calcular_saltos_indptr(longitudes: np.ndarray) -> np.ndarray:
+    saltos_indptr = np.zeros(len(longitudes) + 1, dtype=np.int64)
+    np.cumsum(
+        np.maximum(-(-longitudes.astype(np.int64) // TAMANO_BLOQUE_POSTINGS) - 1, 0),
+        out=saltos_indptr[1:],
+    )
+    return saltos_indptr
+
+
+def comprimir_postings(
+    indptr: np.ndarray, valores: np.ndarray, dtype: np.dtype | None = None
+) -> PostingsComprimidos:
+    longitudes = np.diff(indptr)
+    posiciones_fila = np.arange(len(valores)) - np.repeat(indptr[:-1], longitudes)
+    valores_enteros = valores.astype(np.int64)
+    deltas = valores_enteros.copy()
+    continuan = posiciones_fila > 0
+    deltas[continuan] -= valores_enteros[np.flatnonzero(continuan) - 1]
+
+    datos, inicios_valores = codificar_varint(deltas)
+    bytes_indptr = np.append(inicios_valores, len(datos))[indptr]
+    saltos = np.flatnonzero(continuan & (posiciones_fila % TAMANO_BLOQUE_POSTINGS == 0))
+
+    return PostingsComprimidos(
+        datos,
+        bytes_indptr,
+        longitudes.astype(np.int32),
+        valores_enteros[saltos - 1],
+        inicios_valores[saltos],
+        dtype or valores.dtype,
+    )
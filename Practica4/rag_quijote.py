@@ -3,12 +3,17 @@ from __future__ import annotations
 import os
 import re
 from functools import lru_cache
+from typing import TYPE_CHECKING
 
 import ollama
 
+from almacen_pasajes import AlmacenPasajes
 from buscar_quijote import buscar_pasajes_con_modo
 from busqueda_semantica import buscar_pasajes_semanticos
 
+if TYPE_CHECKING:
+    from biblioteca_libros import BibliotecaLibros
+
 
 MODELO_RAG = os.getenv("FDI_PLN_P4_RAG_MODEL", "llama3.2:3b")
 MAX_RESULTADOS_CLASICOS = 3
@@ -22,12 +27,14 @@ def obtener_cliente_ollama() -> ollama.Client:
 
 def construir_contexto_rag(
     consulta: str,
-    pasajes: list[dict[str, str]],
+    pasajes: AlmacenPasajes | BibliotecaLibros,
     max_clasicos: int = MAX_RESULTADOS_CLASICOS,
     max_semanticos: int = MAX_RESULTADOS_SEMANTICOS,
 ) -> list[dict[str, str]]:
     if max_clasicos > 0:
-        resultados_clasicos, _ = buscar_pasajes_con_modo(pasajes, consulta)
+        resultados_clasicos, _, _ = buscar_pasajes_con_modo(
+            pasajes, consulta, limite=max_clasicos
+        )
     else:
         resultados_clasicos = []
 
@@ -44,7 +51,7 @@ def construir_contexto_rag(
     textos_vistos: set[str] = set()
 
     for indice, resultado in enumerate(resultados_clasicos[:max_clasicos], start=1):
-        texto = resultado["texto"]
+        texto = resultado.texto
         if texto in textos_vistos:
             continue
         textos_vistos.add(texto)
@@ -52,13 +59,13 @@ def construir_contexto_rag(
             {
                 "referencia": f"C{indice}",
                 "fuente": "clasica",
-                "encabezado": resultado["encabezado"],
+                "encabezado": resultado.encabezado,
                 "texto": texto,
             }
         )
 
     for indice, resultado in enumerate(resultados_semanticos[:max_semanticos], start=1):
-        texto = str(resultado["texto"])
+        texto = resultado.texto
         if texto in textos_vistos:
             continue
         textos_vistos.add(texto)
@@ -66,7 +73,7 @@ def construir_contexto_rag(
             {
                 "referencia": f"S{indice}",
                 "fuente": "semantica",
-                "encabezado": str(resultado["encabezado"]),
+                "encabezado": resultado.encabezado,
                 "texto": texto,
             }
         )
@@ -117,7 +124,7 @@ def asegurar_referencias_en_respuesta(
 
 def responder_con_rag(
     consulta: str,
-    pasajes: list[dict[str, str]],
+    pasajes: AlmacenPasajes | BibliotecaLibros,
     modelo: str = MODELO_RAG,
 ) -> dict[str, object]:
     contexto = construir_contexto_rag(consulta, pasajes)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import unicodedata
+
+import numpy as np
+
+
+DISTANCIA_MAXIMA_EXPANSION = 2
+LARGO_MINIMO_EXPANSION = 5
+LIMITE_EXPANSIONES = 3
+LIMITE_CANDIDATOS_TRIGRAMAS = 64
+
+
+def quitar_tildes(palabra: str) -> str:
+    return "".join(
+        caracter
+        for caracter in unicodedata.normalize("NFD", palabra)
+        if not unicodedata.combining(caracter)
+    )
+
+
+def extraer_trigramas(palabra: str) -> set[str]:
+    relleno = f"  {quitar_tildes(palabra)} "
+    return {relleno[inicio : inicio + 3] for inicio in range(len(relleno) - 2)}
+
+
+def calcular_distancia_edicion(origen: str, destino: str, limite: int) -> int:
+    if abs(len(origen) - len(destino)) > limite:
+        return limite + 1
+
+    antepenultima: list[int] = []
+    anterior = list(range(len(destino) + 1))
+
+    for fila, caracter_origen in enumerate(origen, start=1):
+        actual = [fila]
+        for columna, caracter_destino in enumerate(destino, start=1):
+            distancia = min(
+                anterior[columna] + 1,
+                actual[columna - 1] + 1,
+                anterior[columna - 1] + (caracter_origen != caracter_destino),
+            )
+            if (
+                fila > 1
+                and columna > 1
+                and caracter_origen == destino[columna - 2]
+                and origen[fila - 2] == caracter_destino
+            ):
+                distancia = min(distancia, antepenultima[columna - 2] + 1)
+            actual.append(distancia)
+        if min(actual) > limite:
+            return limite + 1
+        antepenultima, anterior = anterior, actual
+
+    return anterior[-1]
+
+
+def obtener_distancia_maxima(palabra: str) -> int:
+    return 1 if len(palabra) <= LARGO_MINIMO_EXPANSION else DISTANCIA_MAXIMA_EXPANSION
+
+
+class IndiceTrigramas:
+    def __init__(
+        self,
+        vocabulario: tuple[str, ...],
+        frecuencias: np.ndarray,
+        ids_trigrama: dict[str, int],
+        indptr: np.ndarray,
+        ids_lemma: np.ndarray,
+    ) -> None:
+        self.vocabulario = vocabulario
+        self.frecuencias = frecuencias
+        self.ids_trigrama = ids_trigrama
+        self.indptr = indptr
+        self.ids_lemma = ids_lemma
+        self.longitudes = np.fromiter(
+            (len(lemma) for lemma in vocabulario),
+            dtype=np.int32,
+            count=len(vocabulario),
+        )
+
+    def buscar_cercanos(self, palabra: str) -> tuple[str, ...]:
+        if len(palabra) < LARGO_MINIMO_EXPANSION:
+            return ()
+
+        distancia_maxima = obtener_distancia_maxima(palabra)
+        trigramas = extraer_trigramas(palabra)
+        listas = [
+            self.ids_lemma[self.indptr[fila] : self.indptr[fila + 1]]
+            for fila in (self.ids_trigrama.get(trigrama) for trigrama in trigramas)
+            if fila is not None
+        ]
+        if not listas:
+            return ()
+
+        candidatos, compartidos = np.unique(np.concatenate(listas), return_counts=True)
+        validos = (compartidos >= len(trigramas) - 4 * distancia_maxima) & (
+            np.abs(self.longitudes[candidatos] - len(palabra)) <= distancia_maxima
+        )
+        candidatos = candidatos[validos]
+        compartidos = compartidos[validos]
+        orden = np.argsort(-compartidos, kind="stable")[:LIMITE_CANDIDATOS_TRIGRAMAS]
+
+        mejores: list[tuple[int, int, str]] = []
+        for id_lemma in candidatos[orden].tolist():
+            lemma = self.vocabulario[id_lemma]
+            distancia = calcular_distancia_edicion(palabra, lemma, distancia_maxima)
+            if distancia <= distancia_maxima:
+                mejores.append((distancia, -int(self.frecuencias[id_lemma]), lemma))
+
+        if not mejores:
+            return ()
+
+        distancia_minima = min(distancia for distancia, _, _ in mejores)
+        return tuple(
+            lemma
+            for distancia, _, lemma in sorted(mejores)
+            if distancia == distancia_minima
+        )[:LIMITE_EXPANSIONES]
+
+
+def construir_indice_trigramas(
+    vocabulario: tuple[str, ...], frecuencias: np.ndarray
+) -> IndiceTrigramas:
+    ids_trigrama: dict[str, int] = {}
+    filas: list[int] = []
+    ids_lemma: list[int] = []
+
+    for id_lemma, lemma in enumerate(vocabulario):
+        for trigrama in extraer_trigramas(lemma):
+            filas.append(ids_trigrama.setdefault(trigrama, len(ids_trigrama)))
+            ids_lemma.append(id_lemma)
+
+    filas_array = np.asarray(filas, dtype=np.int32)
+    orden = np.argsort(filas_array, kind="stable")
+    indptr = np.zeros(len(ids_trigrama) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(filas_array, minlength=len(ids_trigrama)), out=indptr[1:])
+    return IndiceTrigramas(
+        vocabulario,
+        frecuencias,
+        ids_trigrama,
+        indptr,
+        np.asarray(ids_lemma, dtype=np.int32)[orden],
+    )